@@ -0,0 +1,109 @@
+import glob
+import json
+import os
+from argparse import Namespace
+from sources import IMAGE_EXTENSIONS
+
+# Per-process conversion function of a pool worker, set once by init_worker
+_worker_execute = None
+
+
+def batch_inputs(pattern):
+    # A directory means every image in it, anything else is treated as a glob pattern
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        return [path for path in paths if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS]
+    return sorted(glob.glob(pattern))
+
+
+def output_names(inputs, output):
+    # Outputs are named after the input's file name, or after its path below the inputs' common directory with the
+    # extension kept when several inputs share a name, so a.jpg and a.png do not write the same file
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in inputs]
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in inputs]) if inputs else ""
+    names = []
+    for path, stem in zip(inputs, stems):
+        if stems.count(stem) > 1:
+            stem = os.path.relpath(os.path.abspath(path), root).replace(os.sep, "_").replace(".", "_")
+        names.append("{}_{}".format(stem, output))
+    clashes = sorted({name for name in names if names.count(name) > 1})
+    if clashes:
+        raise ValueError("Several inputs would be written to {}".format(", ".join(clashes)))
+    return names
+
+
+def load_manifest(manifest_path):
+    # Inputs already converted by an earlier, possibly interrupted, run
+    done = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as manifest:
+            for line in manifest:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("status") == "done":
+                    done.add(record["input"])
+    return done
+
+
+def init_worker(execute, warm=None, warm_args=()):
+    # Keep the conversion function in the worker and load fonts and ranked charsets once per process
+    global _worker_execute
+    _worker_execute = execute
+    if warm is not None:
+        warm(*warm_args)
+
+
+def convert_one(task):
+    # A failing file is reported back instead of stopping the batch
+    input_path, options = task
+    try:
+        _worker_execute(options)
+        return input_path, options.output, None
+    except Exception as error:
+        return input_path, options.output, f"{type(error).__name__}: {str(error).strip()}"
+
+
+def run_batch(execute, options, warm=None, warm_args=()):
+    # Build one task per input that is not yet recorded as done in the manifest
+    os.makedirs("results", exist_ok=True)
+    manifest_name = options.manifest or "{}_manifest.jsonl".format(os.path.splitext(options.output)[0])
+    manifest_path = os.path.join("results", manifest_name)
+    inputs = batch_inputs(options.batch)
+    done = load_manifest(manifest_path)
+    tasks = []
+    for input_path, output in zip(inputs, output_names(inputs, options.output)):
+        if input_path in done:
+            continue
+        tasks.append((input_path, Namespace(**dict(vars(options), input=input_path, output=output))))
+    print(f"{len(inputs) - len(tasks)} of {len(inputs)} files already converted, {len(tasks)} to go")
+
+    # Convert in a process pool, recording every finished file right away so an interrupted run can resume
+    failed = 0
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        if options.workers > 1:
+            from multiprocessing import Pool
+            pool = Pool(options.workers, initializer=init_worker, initargs=(execute, warm, warm_args))
+            results = pool.imap_unordered(convert_one, tasks)
+        else:
+            pool = None
+            init_worker(execute, warm, warm_args)
+            results = map(convert_one, tasks)
+
+        try:
+            for count, (input_path, output, error) in enumerate(results, 1):
+                record = {"input": input_path, "output": output, "status": "failed" if error else "done"}
+                if error:
+                    record["error"] = error
+                    failed += 1
+                    print(f"[{count}/{len(tasks)}] Failed {input_path}: {error}")
+                else:
+                    print(f"[{count}/{len(tasks)}] Converted {input_path}")
+                manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+                manifest.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    print(f"Batch finished: {len(tasks) - failed} converted, {failed} failed")
@@ -0,0 +1,388 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import queue
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+import cv2
+import numpy as np
+from cells import cell_geometry
+from utils import get_data
+
+# Synthetic input sizes as (width, height)
+IMAGE_SIZES = [(640, 480), (1920, 1080), (3840, 2160)]
+VIDEO_SIZES = [(640, 360), (1280, 720)]
+VIDEO_FRAMES = 30
+
+# Settings swept for every converter: which option each axis sets, and its values
+MATRIX = {
+    "img2txt": {"num_cols": [100, 200, 400], "mode": ["simple", "complex"]},
+    "img2img": {"num_cols": [100, 200, 400], "language": ["english", "general"]},
+    "img2img_color": {"num_cols": [100, 200, 400], "language": ["english", "general"]},
+    "video2video": {"num_cols": [100, 200], "mode": ["simple", "complex"]},
+    "video2video_color": {"num_cols": [100, 200], "mode": ["simple", "complex"]},
+}
+COLOR_SCRIPTS = ("img2img_color", "video2video_color")
+
+# Character matching modes timed side by side at one width, with the other settings at their first values, so the
+# cost of shape matching over luminance mapping is tracked for images and videos. Matching is budgeted at 3x the
+# luminance cell step on images; on videos with cells under 4 pixels wide, where luminance mapping costs a few
+# milliseconds and every cell pixel becomes a tile pixel, it is budgeted at 5x.
+MATCH_MODES = ["luminance", "shape"]
+MATCH_COLS = 200
+MATCH_SCRIPTS = ("img2img", "img2img_color", "video2video", "video2video_color")
+VIDEO_SCRIPTS = ("video2video", "video2video_color")
+
+# Scripts timed from a cold start on a tiny image, where startup is most of the cost
+STARTUP_SCRIPTS = ("img2txt", "img2img", "img2img_color")
+STARTUP_SIZE = (64, 48)
+
+# Thread counts of the banded rendering scaling run, on one large image converted the way a single huge job is
+THREAD_COUNTS = (1, 2, 4, 8, 16)
+THREADS_SIZE = (3840, 2160)
+
+
+def get_args():
+    # Set up argument parser for command line inputs
+    parser = argparse.ArgumentParser("ASCII converter benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Benchmark the converters and save the results as JSON")
+    run.add_argument("--output", type=str, default="results/benchmark.json", help="Path to the results file")
+    run.add_argument("--scripts", type=str, nargs="+", default=list(MATRIX), choices=list(MATRIX),
+                     help="Converters to benchmark")
+    run.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest one is reported")
+    run.add_argument("--quick", action="store_true", help="Only the smallest input and fewest columns")
+
+    startup = commands.add_parser("startup", help="Time each image converter from a cold start on a tiny image")
+    startup.add_argument("--output", type=str, default="results/startup.json", help="Path to the results file")
+    startup.add_argument("--scripts", type=str, nargs="+", default=list(STARTUP_SCRIPTS),
+                         choices=list(STARTUP_SCRIPTS), help="Converters to time")
+    startup.add_argument("--repeat", type=int, default=5, help="Runs per script; the median one is reported")
+
+    threads = commands.add_parser("threads", help="Time one large color image rendered in bands by 1 to 16 threads")
+    threads.add_argument("--output", type=str, default="results/threads.json", help="Path to the results file")
+    threads.add_argument("--input", type=str, default=None, help="Image to convert instead of a synthetic one")
+    threads.add_argument("--num_cols", type=int, default=600, help="Number of characters for output's width")
+    threads.add_argument("--language", type=str, default="english")
+    threads.add_argument("--counts", type=int, nargs="+", default=list(THREAD_COUNTS), help="Thread counts to time")
+    threads.add_argument("--repeat", type=int, default=3, help="Runs per thread count; the fastest one is reported")
+
+    compare = commands.add_parser("compare", help="Compare two results files and flag slowdowns")
+    compare.add_argument("baseline", type=str, help="Results of the reference run")
+    compare.add_argument("current", type=str, help="Results of the run to check")
+    compare.add_argument("--threshold", type=float, default=0.1,
+                         help="Relative increase in wall time reported as a slowdown")
+    return parser.parse_args()
+
+
+def save_report(path, repeat, results, **settings):
+    # Save results as JSON with when and on what machine they were measured, and the settings of the run
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+                    "numpy": np.__version__, "opencv": cv2.__version__},
+        **settings,
+        "repeat": repeat,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Saved {len(results)} results to {path}")
+
+
+def make_image(path, width, height):
+    # Smooth gradients with noise and hard edges, so cells span the whole brightness and color range
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    rng = np.random.default_rng(0)
+    image = np.stack([255 * xs / width, 255 * ys / height, 127.5 + 127.5 * np.sin(xs / 37 + ys / 53)], axis=2)
+    image += rng.normal(0, 20, image.shape)
+    image[(xs // 97 + ys // 89) % 2 == 0] *= 0.5
+    cv2.imwrite(path, np.clip(image, 0, 255).astype(np.uint8))
+
+
+def make_video(path, width, height, frames):
+    # A moving pattern with a static part, so consecutive frames are partly alike like real footage
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height))
+    for frame_idx in range(frames):
+        shift = 8 * frame_idx
+        frame = np.stack([255 * ((xs + shift) % width) / width, 255 * ys / height,
+                          127.5 + 127.5 * np.sin((xs - shift) / 41 + ys / 29)], axis=2)
+        frame[:, width // 2:] = np.stack([255 * ys[:, width // 2:] / height] * 3, axis=2)
+        writer.write(frame.astype(np.uint8))
+    writer.release()
+
+
+def make_inputs(directory, quick):
+    # Write the synthetic images and videos once and return their paths with sizes
+    image_sizes, video_sizes = (IMAGE_SIZES[:1], VIDEO_SIZES[:1]) if quick else (IMAGE_SIZES, VIDEO_SIZES)
+    images, videos = [], []
+    for width, height in image_sizes:
+        path = os.path.join(directory, f"image_{width}x{height}.png")
+        make_image(path, width, height)
+        images.append((path, width, height))
+    for width, height in video_sizes:
+        path = os.path.join(directory, f"video_{width}x{height}.mp4")
+        make_video(path, width, height, VIDEO_FRAMES)
+        videos.append((path, width, height))
+    return images, videos
+
+
+def build_cases(scripts, images, videos, quick):
+    # One case per converter, input and combination of the swept settings
+    cases = []
+    for script in scripts:
+        (axis, values), = [(axis, values) for axis, values in MATRIX[script].items() if axis != "num_cols"]
+        columns = MATRIX[script]["num_cols"][:1] if quick else MATRIX[script]["num_cols"]
+        inputs = videos if script in VIDEO_SCRIPTS else images
+        for path, width, height in inputs:
+            for num_cols in columns:
+                for value in values:
+                    cases.append({
+                        "id": f"{script}/{width}x{height}/{num_cols}/{value}",
+                        "script": script,
+                        "input": path,
+                        "resolution": [width, height],
+                        "num_cols": num_cols,
+                        axis: value,
+                        "color": script in COLOR_SCRIPTS,
+                    })
+        if script not in MATCH_SCRIPTS:
+            continue
+        for path, width, height in inputs:
+            for match in MATCH_MODES:
+                cases.append({
+                    "id": f"{script}/{width}x{height}/{MATCH_COLS}/{values[0]}/{match}",
+                    "script": script,
+                    "input": path,
+                    "resolution": [width, height],
+                    "num_cols": MATCH_COLS,
+                    axis: values[0],
+                    "match": match,
+                    "color": script in COLOR_SCRIPTS,
+                })
+    return cases
+
+
+def case_arguments(case, output):
+    # Command line of the converter for one case, with everything else left at its defaults
+    arguments = ["--input", case["input"], "--output", output, "--num_cols", str(case["num_cols"])]
+    if "language" in case:
+        mode = "complex" if case["language"] == "general" else "standard"
+        arguments += ["--language", case["language"], "--mode", mode]
+    else:
+        arguments += ["--mode", case["mode"]]
+    if "match" in case:
+        arguments += ["--match", case["match"]]
+    return arguments
+
+
+def run_case(case, repeat, results):
+    # Runs in a fresh process, so peak RSS and loaded data belong to this case alone
+    module = importlib.import_module(case["script"])
+    extension = ".mp4" if case["script"] in VIDEO_SCRIPTS else ".txt" if case["script"] == "img2txt" else ".png"
+    output = f"benchmark_{os.getpid()}{extension}"
+    parse = getattr(module, "get_args", None) or module.parse_arguments
+    sys.argv = [case["script"]] + case_arguments(case, output)
+    options = parse()
+
+    try:
+        # Converter progress messages would drown the report
+        times = []
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                module.execute_conversion(argparse.Namespace(**vars(options)))
+                times.append(time.perf_counter() - start)
+
+            # Cells per frame follow from the same geometry the converter uses
+            width, height = case["resolution"]
+            scale = 2
+            if "language" in case:
+                scale = get_data(case["language"], options.mode)[3]
+            _, _, num_cols, num_rows = cell_geometry(height, width, case["num_cols"], scale)
+        results.put({"wall": min(times), "cells": num_cols * num_rows,
+                     "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+    except Exception as error:
+        results.put({"error": f"{type(error).__name__}: {str(error).strip()}"})
+    finally:
+        if os.path.exists(os.path.join("results", output)):
+            os.remove(os.path.join("results", output))
+
+
+def measure(case, repeat):
+    # Run one case in its own process and derive throughput from its fastest run
+    context = get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_case, args=(case, repeat, results))
+    process.start()
+
+    # A case whose process dies without reporting counts as failed
+    measured = None
+    while measured is None:
+        try:
+            measured = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                measured = {"error": f"process exited with code {process.exitcode}"}
+    process.join()
+
+    result = dict(case, **measured)
+    if "error" not in result:
+        frames = VIDEO_FRAMES if case["script"] in VIDEO_SCRIPTS else 1
+        result["frames"] = frames
+        result["cells_per_s"] = result["cells"] * frames / result["wall"]
+        result["fps"] = frames / result["wall"]
+    return result
+
+
+def run(options):
+    # Generate the inputs, run every case and save the results with a description of the machine
+    cases_done = []
+    with tempfile.TemporaryDirectory() as directory:
+        images, videos = make_inputs(directory, options.quick)
+        cases = build_cases(options.scripts, images, videos, options.quick)
+        for count, case in enumerate(cases, 1):
+            result = measure(case, options.repeat)
+            result["input"] = os.path.basename(case["input"])
+            cases_done.append(result)
+            if "error" in result:
+                print(f"[{count}/{len(cases)}] {case['id']}: failed, {result['error']}")
+            else:
+                print(f"[{count}/{len(cases)}] {case['id']}: {result['wall']:.3f}s, "
+                      f"{result['cells_per_s']:,.0f} cells/s, {result['fps']:.2f} FPS, "
+                      f"{result['peak_rss_mb']:.0f} MB")
+
+    save_report(options.output, options.repeat, cases_done)
+
+
+def import_seconds(script):
+    # Time Python reports for importing the script module and everything it imports
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {script}"], capture_output=True,
+                            text=True, check=True)
+    return int(result.stderr.strip().splitlines()[-1].split("|")[1]) / 1e6
+
+
+def run_child(arguments):
+    # Run a command to completion and return the peak RSS of that process alone, in MB; RUSAGE_CHILDREN would give
+    # the largest peak of every child waited for so far
+    process = subprocess.Popen(arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, arguments)
+    return usage.ru_maxrss / 1024
+
+
+def startup(options):
+    # A whole conversion of a tiny image as a new process, the way a single job launched from a shell pays for it
+    cases_done = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tiny.png")
+        make_image(path, *STARTUP_SIZE)
+        for script in options.scripts:
+            extension = ".txt" if script == "img2txt" else ".png"
+            output = f"startup_{os.getpid()}{extension}"
+            arguments = [sys.executable, f"{script}.py", "--input", path, "--output", output, "--num_cols", "20"]
+            if script != "img2txt":
+                arguments += ["--language", "english"]
+            times, peaks = [], []
+            for _ in range(options.repeat):
+                start = time.perf_counter()
+                peaks.append(run_child(arguments))
+                times.append(time.perf_counter() - start)
+            os.remove(os.path.join("results", output))
+
+            result = {"id": f"startup/{script}", "script": script, "wall": statistics.median(times),
+                      "import_s": import_seconds(script), "peak_rss_mb": max(peaks)}
+            cases_done.append(result)
+            print(f"{script}: {result['wall'] * 1000:.0f} ms per run, {result['import_s'] * 1000:.0f} ms of imports")
+
+    save_report(options.output, options.repeat, cases_done)
+
+
+def threads(options):
+    # Rendering time of one image at each thread count, its speedup over one thread and the share of the ideal
+    # speedup it reaches; every count must give the image one thread gives
+    from converter import AsciiConverter
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = options.input or os.path.join(directory, "large.png")
+        if options.input is None:
+            make_image(path, *THREADS_SIZE)
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+
+    cases_done = []
+    reference = None
+    for count in options.counts:
+        times = []
+        for _ in range(options.repeat):
+            # A new converter each run, so no run reuses the output buffer of the one before, as in a single job
+            converter = AsciiConverter(options.language, num_cols=options.num_cols, color=True, threads=count)
+            indices, colors = converter.cells(image)
+            start = time.perf_counter()
+            out_image = converter.render(indices, colors)
+            times.append(time.perf_counter() - start)
+        if reference is None:
+            reference = out_image
+        result = {"id": f"threads/{count}", "threads": count, "wall": min(times),
+                  "identical": reference.shape == out_image.shape and bool((reference == out_image).all()),
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        result["speedup"] = cases_done[0]["wall"] / result["wall"] if cases_done else 1.0
+        result["efficiency"] = result["speedup"] / count
+        cases_done.append(result)
+        print(f"{count} threads: {result['wall']:.3f}s, {result['speedup']:.2f}x, "
+              f"{result['efficiency']:.0%} efficiency{'' if result['identical'] else ', OUTPUT DIFFERS'}")
+
+    save_report(options.output, options.repeat, cases_done,
+                input=os.path.basename(options.input) if options.input else f"{THREADS_SIZE[0]}x{THREADS_SIZE[1]}",
+                num_cols=options.num_cols, shape=list(reference.shape))
+    return 0 if all(result["identical"] for result in cases_done) else 1
+
+
+def compare(options):
+    # Match cases by id and report how much slower or faster each one got
+    with open(options.baseline, encoding="utf-8") as baseline_file:
+        baseline = {result["id"]: result for result in json.load(baseline_file)["results"]}
+    with open(options.current, encoding="utf-8") as current_file:
+        current = {result["id"]: result for result in json.load(current_file)["results"]}
+
+    slowdowns = 0
+    for case_id in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[case_id], current[case_id]
+        if "error" in old or "error" in new:
+            print(f"{case_id}: failed in {'baseline' if 'error' in old else 'current'} run")
+            continue
+        change = new["wall"] / old["wall"] - 1
+        flag = "SLOWER" if change > options.threshold else ""
+        slowdowns += bool(flag)
+        print(f"{case_id}: {old['wall']:.3f}s -> {new['wall']:.3f}s ({change:+.1%}), "
+              f"RSS {old['peak_rss_mb']:.0f} -> {new['peak_rss_mb']:.0f} MB {flag}".rstrip())
+
+    for case_id in sorted(baseline.keys() ^ current.keys()):
+        print(f"{case_id}: only in the {'baseline' if case_id in baseline else 'current'} run")
+
+    print(f"{slowdowns} of {len(baseline.keys() & current.keys())} cases slower by more than {options.threshold:.0%}")
+    return 1 if slowdowns else 0
+
+
+if __name__ == '__main__':
+    options = get_args()
+    if options.command == "run":
+        run(options)
+    elif options.command == "startup":
+        startup(options)
+    elif options.command == "threads":
+        sys.exit(threads(options))
+    else:
+        sys.exit(compare(options))
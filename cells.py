@@ -0,0 +1,164 @@
+import cv2
+import numpy as np
+
+
+def cell_geometry(height, width, num_cols, scale):
+    # Calculate cell dimensions for ASCII representation
+    cell_width = width / num_cols
+    cell_height = scale * cell_width
+    num_rows = int(height / cell_height)
+
+    # Adjust cell dimensions if they exceed image dimensions
+    if num_cols > width or num_rows > height:
+        print("Too many columns or rows. Using default settings.")
+        cell_width = 6
+        cell_height = 12
+        num_cols = int(width / cell_width)
+        num_rows = int(height / cell_height)
+
+    return cell_width, cell_height, num_cols, num_rows
+
+
+def cell_edges(cell_size, count, limit):
+    # Pixel boundaries of each cell, matching int(i * cell_size) and min(int((i + 1) * cell_size), limit)
+    return np.minimum((np.arange(count + 1) * cell_size).astype(np.int64), limit)
+
+
+def cell_sums(image, cell_width, cell_height, num_cols, num_rows, row_edges=None):
+    # Sum pixel values of every cell in one batched pass and count the pixels per cell; row_edges, relative to
+    # the top of image, lets a horizontal strip of a larger image keep the cell rows of the whole image
+    height, width = image.shape[:2]
+    if row_edges is None:
+        row_edges = cell_edges(cell_height, num_rows, height)
+    num_rows = len(row_edges) - 1
+    col_edges = cell_edges(cell_width, num_cols, width)
+    if num_rows == 0 or num_cols == 0:
+        return np.zeros((num_rows, num_cols) + image.shape[2:], np.int64), np.ones((num_rows, num_cols), np.int64)
+
+    # Collapse each cell-row band to one line of column sums, then sum the columns of every cell
+    bands = np.stack([image[top:bottom].sum(axis=0, dtype=np.uint32)
+                      for top, bottom in zip(row_edges[:-1], row_edges[1:])])
+    sums = np.add.reduceat(bands[:, :col_edges[-1]], col_edges[:-1], axis=1, dtype=np.int64)
+    counts = np.outer(np.diff(row_edges), np.diff(col_edges))
+    return sums, counts
+
+
+def integral_table(image):
+    # Summed-area table of a whole image, from which the sum over any rectangle costs four lookups whatever its
+    # size (32-bit sums are exact while every channel of the whole image sums to less than 2^31)
+    pixels = image.shape[0] * image.shape[1]
+    return cv2.integral(image, sdepth=cv2.CV_32S if pixels < 2 ** 31 // 255 else cv2.CV_64F)
+
+
+def table_sums(table, cell_width, cell_height, num_cols, num_rows):
+    # Sum of every cell and its pixel count read off the summed-area table of the image, for any cell size
+    row_edges = cell_edges(cell_height, num_rows, table.shape[0] - 1)
+    col_edges = cell_edges(cell_width, num_cols, table.shape[1] - 1)
+    sums = np.diff(np.diff(table[row_edges], axis=0)[:, col_edges], axis=1).astype(np.int64)
+    return sums, np.outer(np.diff(row_edges), np.diff(col_edges))
+
+
+def cell_means(image, cell_width, cell_height, num_cols, num_rows, row_edges=None, table=None):
+    # Average brightness (rows x cols) and, for color input, average color (rows x cols x 3) of every cell, summed
+    # from the pixels or, when the summed-area table of the whole image is given, read off the table
+    if table is not None:
+        sums, counts = table_sums(table, cell_width, cell_height, num_cols, num_rows)
+    else:
+        sums, counts = cell_sums(image, cell_width, cell_height, num_cols, num_rows, row_edges)
+    if sums.ndim == 2:
+        return sums / counts, None
+    brightness = sums.sum(axis=2) / (counts * sums.shape[2])
+    colors = sums / counts[:, :, None]
+    return brightness, colors
+
+
+def split_edges(edges, parts):
+    # Boundaries of parts nearly equal pieces of every interval between edges, ending with the last edge
+    starts = edges[:-1, None] + np.diff(edges)[:, None] * np.arange(parts) // parts
+    return np.append(starts.ravel(), edges[-1])
+
+
+def cell_tiles(image, cell_width, cell_height, num_cols, num_rows, tile_shape, row_edges=None, table=None):
+    # Every cell of a grayscale image averaged down to tile_height x tile_width blocks, flattened to
+    # (rows, cols, tile_height * tile_width); cells must be at least as large as the tile. The summed-area table of
+    # the image is built here unless it is given.
+    height, width = image.shape
+    if row_edges is None:
+        row_edges = cell_edges(cell_height, num_rows, height)
+    num_rows = len(row_edges) - 1
+    col_edges = cell_edges(cell_width, num_cols, width)
+    tile_height, tile_width = tile_shape
+    if num_rows == 0 or num_cols == 0:
+        return np.zeros((num_rows, num_cols, tile_height * tile_width))
+
+    # Block sums over a grid tile_height x tile_width times finer than the cells, read off a summed-area table
+    ys, xs = split_edges(row_edges, tile_height), split_edges(col_edges, tile_width)
+    if table is None:
+        table = integral_table(image[:ys[-1], :xs[-1]])
+    sums = np.diff(np.diff(table[ys], axis=0)[:, xs], axis=1).astype(np.float32)
+    means = sums * np.outer(1 / np.diff(ys).astype(np.float32), 1 / np.diff(xs).astype(np.float32))
+    return means.reshape(num_rows, tile_height, num_cols, tile_width).transpose(0, 2, 1, 3).reshape(
+        num_rows, num_cols, tile_height * tile_width)
+
+
+def match_tiles(tiles, templates, bias, contrast=16):
+    # Index of the best template for every tile, all scored in one matrix product. A tile is scaled to unit length
+    # around its mean like the templates, except that tiles with less than contrast levels of RMS contrast keep
+    # their weaker shape, and its mean brightness and a one are appended to meet the brightness coordinate and
+    # the bias of the templates. The templates are centered, so the tile's mean drops out of the shape product and
+    # the tile itself need not be centered.
+    flat = tiles.reshape(-1, tiles.shape[-1]).astype(np.float32, copy=False)
+    count, size = flat.shape
+    means = flat.mean(axis=1)
+    squares = np.einsum("ij,ij->i", flat, flat) - size * means * means
+    coords = np.empty((count, size + 2), np.float32)
+    np.multiply(flat, (1 / np.maximum(np.sqrt(np.maximum(squares, 0)), contrast * size ** 0.5))[:, None],
+                out=coords[:, :size])
+    coords[:, size] = means
+    coords[:, size + 1] = 1
+    scores = coords @ np.vstack([templates.T, bias]).astype(np.float32)
+    return scores.argmax(axis=1).reshape(tiles.shape[:2])
+
+
+def gamma_curve(gamma):
+    # Brightness levels raised to a power, moving mid tones toward the start (gamma > 1) or the end (gamma < 1)
+    # of the character list
+    return 255 * (np.arange(256) / 255) ** gamma
+
+
+def level_histogram(brightness):
+    # Number of cells at each of the 256 brightness levels, fractions dropped
+    return np.bincount(brightness.astype(np.uint8).ravel(), minlength=256)
+
+
+def equalize_curve(brightness, histogram=None):
+    # Brightness levels spread by their share of cells, so every character gets used about equally often; the
+    # histogram of the cells can be given instead, summed over the parts of a larger image
+    if histogram is None:
+        histogram = level_histogram(brightness)
+    cdf = np.cumsum(histogram)
+    lowest = cdf[np.flatnonzero(histogram)[0]] if cdf[-1] else 0
+    return 255 * np.maximum(cdf - lowest, 0) / max(cdf[-1] - lowest, 1)
+
+
+def char_indices(brightness, num_chars):
+    # Map average brightness to an index into the character list, from the unrounded cell means
+    return np.minimum((brightness * num_chars / 255).astype(np.int64), num_chars - 1)
+
+
+def brightness_table(num_chars, curve=None):
+    # Character index of each of the 256 brightness levels after a curve over the levels, for char_indices of the
+    # curved brightness in one lookup
+    levels = np.arange(256) if curve is None else curve
+    return char_indices(levels, num_chars).astype(np.uint8)
+
+
+def map_brightness(brightness, table):
+    # Character index of every cell with one lookup of its brightness level
+    return np.take(table, brightness.astype(np.uint8))
+
+
+def grid_to_lines(indices, char_list):
+    # Turn a grid of character indices into one string per row
+    chars = np.array(list(char_list))
+    return ["".join(row) for row in chars[indices]]
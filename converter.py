@@ -0,0 +1,446 @@
+import cv2
+import numpy as np
+from functools import partial
+from utils import get_data
+from cells import (cell_geometry, cell_edges, cell_means, cell_tiles, integral_table, match_tiles, char_indices,
+                   brightness_table, gamma_curve, equalize_curve, level_histogram, map_brightness, grid_to_lines)
+from glyphs import (build_atlas, glyph_templates, render_lines, render_cells, render_indexed, render_incremental,
+                    affected_cells, content_bbox, grid_bbox, grid_extent)
+from palette import ansi_palette, fit_palette, palette_lookup, palette_entries, shade_table, apply_shades
+from markup import color_keys, write_markup
+from timing import clock, lap
+
+# Glyph atlases already rasterized in this process, shared by converters using the same characters and font
+_atlas_memo = {}
+
+# Largest glyph template in shape mode; bigger glyphs are averaged down to about this many pixels, which keeps their
+# structure and keeps matching within a few times the cost of brightness mapping
+SHAPE_TILE_PIXELS = 64
+
+# Frame sizes whose layouts, glyph templates and crops a converter keeps, the least recently used dropped first; a
+# server's converters see a new size with every request. Only the last size keeps its output buffer.
+KEPT_SIZES = 8
+
+
+def kept(cache, key, make, size=KEPT_SIZES):
+    # Value of key in a dict used as a small LRU cache, made when missing and then dropping the oldest entries
+    if key in cache:
+        cache[key] = cache.pop(key)
+    else:
+        cache[key] = make()
+        while len(cache) > size:
+            del cache[next(iter(cache))]
+    return cache[key]
+
+
+def shared_frame(converters, image, times=None):
+    # The frame in the channels the converters reduce, with its summed-area table when there are several of them:
+    # each converter then reads its cells off the same table, whatever its cell size
+    start = clock(times)
+    color = converters[0].color
+    if color and image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    elif not color and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    start = lap(times, "convert", start)
+    table = integral_table(image) if len(converters) > 1 else None
+    lap(times, "reduce", start)
+    return image, table
+
+
+def shared_frames(converters, images, times=None):
+    # shared_frame for converters that each have their own image, converters given the same image sharing it
+    groups = {}
+    for converter, image in zip(converters, images):
+        groups.setdefault(id(image), (image, []))[1].append(converter)
+    frames = {key: shared_frame(group, image, times) for key, (image, group) in groups.items()}
+    return [frames[id(image)] for image in images]
+
+
+class AsciiConverter:
+    # Converts images and video frames to ASCII art. Everything that only depends on the settings is prepared once,
+    # and everything that depends on the frame or output size once per size, so many frames repeat no setup.
+
+    def __init__(self, language="english", mode="standard", num_cols=100, color=False, background="black",
+                 char_list=None, font=None, sample_char="A", scale=2, incremental=False, color_tolerance=0,
+                 rebuild_cache=False, gamma=1.0, equalize=False, match="luminance", palette=None,
+                 fixed_frame=False, threads=1):
+        # Take the ranked character set and font of a language unless a character list is given directly
+        if char_list is None:
+            char_list, font, sample_char, scale = get_data(language, mode, rebuild_cache)
+            if char_list is None:
+                raise ValueError(f"No character set for language {language} and mode {mode}")
+
+        self.char_list = char_list
+        self.font = font
+        self.sample_char = sample_char
+        self.scale = scale
+        self.num_cols = num_cols
+        self.color = color
+        self.incremental = incremental
+        self.color_tolerance = color_tolerance
+        self.background = background
+        level = 255 if background == "white" else 0
+        self.bg_color = (level, level, level) if color else level
+        self.dirty_ratio = 1.0
+
+        # Video frames keep one size, the area any glyph can reach, instead of being cropped to their content
+        self.fixed_frame = fixed_frame
+
+        # Single images are rendered in horizontal bands of cell rows, one thread each, when threads is above 1
+        self.threads = threads
+
+        # Brightness to character lookup through a gamma curve, compiled once unless it is equalized for every image or
+        # frame; without a curve the unrounded brightness is mapped directly
+        self.equalize = equalize
+        self.curve = gamma_curve(gamma) if gamma != 1 else None
+        self.table = None if self.curve is None else brightness_table(len(char_list), self.curve)
+
+        # Characters are chosen by brightness alone, or in shape mode by how closely their glyph resembles the cell
+        if match not in ("luminance", "shape"):
+            raise ValueError(f"Unknown match mode {match}")
+        self.match = match
+
+        # Colors can be quantized to a palette: a number of colors fitted to the first colors converted unless
+        # set_palette is called before, or "ansi" for the fixed xterm 256-color palette
+        self.palette_size = palette
+        self.palette = None
+        if palette == "ansi":
+            self.set_palette(ansi_palette())
+
+        self._glyphs = None
+        self._templates = {}
+        self._layouts = {}
+        self._buffers = {}
+        self._crops = {}
+        self._previous = {}
+
+    def glyphs(self):
+        # Character size and glyph atlas, rasterized the first time a frame is rendered by any converter with the
+        # same characters and font
+        if self._glyphs is None:
+            key = self.char_list, getattr(self.font, "path", None) or id(self.font), self.font.size, self.sample_char
+            if key not in _atlas_memo:
+                char_bbox = self.font.getbbox(self.sample_char)
+                char_size = char_bbox[2], char_bbox[3]
+                _atlas_memo[key] = (char_size, *build_atlas(self.char_list, self.font, *char_size))
+            self._glyphs = _atlas_memo[key]
+        return self._glyphs
+
+    def set_palette(self, palette):
+        # Use a palette of BGR colors from now on, with its color lookup and its shades over the background
+        self.palette = palette
+        self._palette_lookup = palette_lookup(palette)
+        self._shades = shade_table(palette, self.bg_color)
+
+    def quantize(self, colors):
+        # Palette entry of every cell color, fitting the palette to these colors if there is none yet
+        if self.palette is None:
+            self.set_palette(fit_palette(colors, self.palette_size))
+        return palette_entries(colors, self._palette_lookup)
+
+    def layout(self, shape):
+        # Cell geometry of one input frame size
+        key = tuple(shape[:2])
+        return kept(self._layouts, key, lambda: {"geometry": cell_geometry(key[0], key[1], self.num_cols, self.scale)})
+
+    def templates(self, geometry):
+        # Glyph templates for shape matching, at the glyph size or smaller for large glyphs and small cells
+        cell_width, cell_height = geometry[:2]
+        (char_width, char_height), atlas, origin = self.glyphs()
+        factor = max(1.0, (char_width * char_height / SHAPE_TILE_PIXELS) ** 0.5)
+        tile_shape = (max(1, min(round(char_height / factor), int(cell_height))),
+                      max(1, min(round(char_width / factor), int(cell_width))))
+        return kept(self._templates, tile_shape, lambda: (tile_shape, *glyph_templates(atlas, origin, tile_shape)))
+
+    def cells(self, image, times=None, geometry=None, row_edges=None, table=None, curve=None):
+        # Character index and, in color, average color of every cell of a BGR or grayscale frame, optionally read off
+        # the frame's summed-area table from shared_frame
+        if self.match == "shape":
+            # Shape mode needs no cell brightness, only the cell colors in color
+            colors = self.reduce(image, times, geometry, row_edges, table)[1] if self.color else None
+            start = clock(times)
+            indices = self.shapes(image, geometry, row_edges, table, curve)
+        else:
+            brightness, colors = self.reduce(image, times, geometry, row_edges, table)
+            start = clock(times)
+            indices = self.map(brightness)
+        lap(times, "map", start)
+        return indices, colors
+
+    def map(self, brightness):
+        # Character index of every cell, from a table equalized over these cells when asked for
+        table = self.table
+        if self.equalize:
+            table = brightness_table(len(self.char_list), equalize_curve(brightness))
+        if table is None:
+            return char_indices(brightness, len(self.char_list))
+        return map_brightness(brightness, table)
+
+    def tiles(self, image, geometry=None, row_edges=None, table=None):
+        # Every cell downsampled to the glyph template size, with the templates. Only a grayscale summed-area table
+        # is reused.
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            table = None
+        geometry = geometry or self.layout(image.shape)["geometry"]
+        tile_shape, templates, bias = self.templates(geometry)
+        return cell_tiles(image, *geometry, tile_shape, row_edges, table), templates, bias
+
+    def shapes(self, image, geometry=None, row_edges=None, table=None, curve=None):
+        # Character index of every cell whose glyph best matches the cell downsampled to the glyph size; a gamma or
+        # equalization curve applies to the downsampled pixels, equalized over these cells unless a curve is given
+        tiles, templates, bias = self.tiles(image, geometry, row_edges, table)
+        if curve is None:
+            curve = equalize_curve(tiles) if self.equalize else self.curve
+        if curve is not None:
+            tiles = np.interp(tiles, np.arange(256), curve)
+        return match_tiles(tiles, templates, bias)
+
+    def reduce(self, image, times=None, geometry=None, row_edges=None, table=None):
+        # Average brightness and, in color, average color of every cell; a strip of a larger image passes the
+        # geometry of the whole image and its own cell row edges. A summed-area table of the image in the
+        # converter's channels replaces summing the pixels.
+        start = clock(times)
+        if self.color and image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif not self.color and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        start = lap(times, "convert", start)
+
+        brightness, colors = cell_means(image, *(geometry or self.layout(image.shape)["geometry"]), row_edges, table)
+        lap(times, "reduce", start)
+        return brightness, colors
+
+    def convert_text(self, image, table=None):
+        # ASCII art as text, one line per cell row, always from the grayscale frame and its summed-area table if given
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        brightness, _ = cell_means(image, *self.layout(image.shape)["geometry"], table=table)
+        lines = grid_to_lines(self.map(brightness), self.char_list)
+        return "".join(line + "\n" for line in lines)
+
+    def convert_frame(self, image, times=None, table=None):
+        # ASCII art as an image in the channel order of the input, cropped to its content
+        indices, colors = self.cells(image, times, table=table)
+        return self.render(indices, colors, times)
+
+    def render(self, indices, colors=None, times=None):
+        # Image of a character grid and, in color, its color grid, cropped to its content or, for fixed frames, to
+        # where any glyph of the grid could reach
+        (char_width, char_height), atlas, origin = self.glyphs()
+        num_rows, num_cols = indices.shape
+        out_shape = (self.scale * char_height * num_rows, char_width * num_cols)
+        start = clock(times)
+
+        if self.incremental:
+            # Re-render only cells whose character or color changed since the previous frame
+            previous = self._previous
+            if colors is not None and self.palette_size:
+                out_image, self.dirty_ratio = self.render_changed(indices, colors, out_shape)
+            else:
+                out_image, self.dirty_ratio = render_incremental(
+                    previous, indices, atlas, origin, out_shape, self.bg_color, colors=colors,
+                    fill=255 - self.bg_color if colors is None else None, tolerance=self.color_tolerance)
+            start = lap(times, "render", start)
+            if not self.fixed_frame and (self.dirty_ratio or "bbox" not in previous):
+                previous["bbox"] = content_bbox(out_image, self.bg_color)
+            bbox = previous.get("bbox")
+        elif self.threads > 1:
+            out_image = self.render_bands(partial(self.render_grid, keep=False), indices, colors, out_shape,
+                                          self.bg_color)
+            start = lap(times, "render", start)
+            bbox = None if self.fixed_frame else content_bbox(out_image, self.bg_color)
+        else:
+            out_image = self.render_grid(indices, colors, out_shape)
+            start = lap(times, "render", start)
+            bbox = None if self.fixed_frame else content_bbox(out_image, self.bg_color)
+
+        # A fixed frame is a view of the buffers kept between frames, valid until the next frame is rendered
+        if self.fixed_frame:
+            left, top, right, bottom = kept(self._crops, out_shape,
+                                            lambda: grid_extent(atlas, origin, indices.shape, out_shape))
+            lap(times, "crop", start)
+            return out_image[top:bottom, left:right]
+
+        # Crop to the content, copying so the buffers kept between frames never leave the converter
+        if bbox is not None:
+            left, top, right, bottom = bbox
+            out_image = out_image[top:bottom, left:right]
+        out_image = out_image.copy()
+        lap(times, "crop", start)
+        return out_image
+
+    def convert_indexed(self, image, table=None):
+        # ASCII art as an index image into the returned BGR color table, cropped to its content; needs a palette
+        indices, colors = self.cells(image, table=table)
+        (char_width, char_height), _, _ = self.glyphs()
+        num_rows, num_cols = indices.shape
+        out_shape = (self.scale * char_height * num_rows, char_width * num_cols)
+        if self.threads > 1:
+            out_image = self.render_bands(self.render_index, indices, colors, out_shape, 0)
+        else:
+            out_image = self.render_index(indices, colors, out_shape)
+        bbox = content_bbox(out_image, 0)
+        if bbox is not None:
+            left, top, right, bottom = bbox
+            out_image = out_image[top:bottom, left:right]
+        return out_image.copy(), self._shades[0]
+
+    def convert_markup(self, image, file, kind="html", table=None):
+        # Color ASCII art as HTML or SVG text written to a file, cells of equal color, or of equal palette entry with a
+        # palette, merged into one element
+        indices, colors = self.cells(image, table=table)
+        entries = self.quantize(colors) if self.palette_size else None
+        keys, key_colors = color_keys(colors, entries, self.palette)
+        char_size, _, _ = self.glyphs()
+        write_markup(file, kind, indices, keys, key_colors, self.char_list, self.font, char_size, self.bg_color)
+
+    def render_index(self, indices, colors, out_shape):
+        # Uncropped index image of a character grid colored by palette entry
+        (char_width, char_height), atlas, origin = self.glyphs()
+        entries = self.quantize(colors)
+        return render_indexed(indices, entries, atlas, origin, out_shape, self._shades[1])
+
+    def render_grid(self, indices, colors, out_shape, keep=True):
+        # Uncropped image of a character grid, color frames going into a buffer kept for their size unless keep is
+        # false; with a palette the index image is rendered and looked up in its color table, unless the palette
+        # has too many colors for two coverage shades each, like ansi, and glyphs are blended in its colors instead
+        (char_width, char_height), atlas, origin = self.glyphs()
+        if not self.color:
+            return render_lines(indices, atlas, origin, out_shape, 255 - self.bg_color, self.bg_color)
+        if self.palette_size:
+            entries = self.quantize(colors)
+            if self._shades[1] > 1:
+                out_image = render_indexed(indices, entries, atlas, origin, out_shape, self._shades[1])
+                return apply_shades(out_image, self._shades[0])
+            colors = self.palette[entries]
+        if not keep:
+            return render_cells(indices, colors, atlas, origin, out_shape, self.bg_color)
+        buffer = kept(self._buffers, out_shape, lambda: np.empty(out_shape + (3,), np.uint8), 1)
+        return render_cells(indices, colors, atlas, origin, out_shape, self.bg_color, buffer)
+
+    def render_changed(self, indices, colors, out_shape):
+        # Incremental rendering with a palette: a cell changed when its character or palette entry did, and the band
+        # of cell rows the glyphs of changed cells reach is rendered again the way a full frame is
+        entries = self.quantize(colors)
+        state = self._previous
+        if "out" not in state or state["indices"].shape != indices.shape:
+            state["out"] = self.render_grid(indices, colors, out_shape)
+            state["indices"], state["entries"] = indices.copy(), entries
+            return state["out"], 1.0
+
+        dirty = (indices != state["indices"]) | (entries != state["entries"])
+        if dirty.any():
+            (_, char_height), atlas, origin = self.glyphs()
+            cell_ys, _ = affected_cells(dirty, atlas, origin, indices.shape)
+            first, last = int(cell_ys.min()), int(cell_ys.max()) + 1
+            band = self.render_band(self.render_grid, indices, colors, out_shape, first, last)
+            state["out"][first * char_height:first * char_height + len(band)] = band
+            state["indices"], state["entries"] = indices.copy(), entries
+        return state["out"], dirty.mean()
+
+    def render_band(self, draw, indices, colors, out_shape, first, last):
+        # Pixel rows of cell rows first to last of the image of out_shape, the last band reaching down to its
+        # bottom. draw renders them along with the rows whose glyphs reach into them, so bands join without seams.
+        (char_width, char_height), atlas, origin = self.glyphs()
+        num_rows = indices.shape[0]
+        reach_up, reach_down = origin[0], atlas.shape[0] - 1 - origin[0]
+        grid_top, grid_bottom = max(0, first - reach_down), min(num_rows, last + reach_up)
+        grid_height = min(out_shape[0], (grid_bottom + reach_down) * char_height) - grid_top * char_height
+        out_image = draw(indices[grid_top:grid_bottom], None if colors is None else colors[grid_top:grid_bottom],
+                         (grid_height, out_shape[1]))
+        offset = grid_top * char_height
+        bottom = last * char_height if last < num_rows else out_shape[0]
+        return out_image[first * char_height - offset:bottom - offset]
+
+    def render_bands(self, draw, indices, colors, out_shape, background):
+        # Uncropped image of a character grid drawn by draw in one band of cell rows per thread, each thread
+        # writing its band into its rows of the output. Most of the drawing is numpy array work, which releases the GIL.
+        from concurrent.futures import ThreadPoolExecutor
+
+        # A palette is fitted once to the colors of the whole grid, never to those of one band
+        if colors is not None and self.palette_size and self.palette is None:
+            self.quantize(colors)
+        (_, char_height), _, _ = self.glyphs()
+        num_rows = indices.shape[0]
+        out_image = np.empty(out_shape + np.shape(background), np.uint8)
+        edges = np.linspace(0, num_rows, min(self.threads, num_rows) + 1).round().astype(int).tolist()
+
+        def fill(first, last):
+            band = self.render_band(draw, indices, colors, out_shape, first, last)
+            out_image[first * char_height:first * char_height + len(band)] = band
+            return first * char_height + len(band)
+
+        with ThreadPoolExecutor(len(edges) - 1) as pool:
+            bottom = max(pool.map(fill, edges[:-1], edges[1:]))
+        # Rows below the reach of the last cell row are background
+        out_image[bottom:] = background
+        return out_image
+
+    def strips(self, reader, strip_rows):
+        # Whole cell rows of the image, strip_rows at a time, with their cell row edges relative to the strip
+        geometry = self.layout((reader.height, reader.width))["geometry"]
+        row_edges = cell_edges(geometry[1], geometry[3], reader.height)
+        for first in range(0, geometry[3], strip_rows):
+            last = min(first + strip_rows, geometry[3])
+            strip = reader.read(row_edges[first], row_edges[last])
+            yield strip, geometry, row_edges[first:last + 1] - row_edges[first]
+
+    def convert_tiled(self, reader, path, strip_rows=64):
+        from tiles import open_image_writer
+
+        # Shape mode equalizes its tiles with one curve for the whole image, from their histogram gathered in a first
+        # pass over the strips
+        curve = None
+        if self.match == "shape" and self.equalize:
+            histogram = sum(level_histogram(self.tiles(strip, geometry, edges)[0])
+                            for strip, geometry, edges in self.strips(reader, strip_rows))
+            curve = equalize_curve(None, histogram)
+
+        # Reduce the image strip by strip to its character and color grids, which are small even for huge images
+        grids = [self.cells(strip, geometry=geometry, row_edges=edges, curve=curve) if self.match == "shape" else
+                 self.reduce(strip, geometry=geometry, row_edges=edges)
+                 for strip, geometry, edges in self.strips(reader, strip_rows)]
+        indices = np.concatenate([grid[0] for grid in grids])
+        if self.match != "shape":
+            indices = self.map(indices)
+        colors = np.concatenate([grid[1] for grid in grids]) if self.color else None
+        bbox_colors = colors
+        if colors is not None and self.palette_size:
+            # The palette is fitted to the whole image, and the crop follows from the colors it gives
+            entries = self.quantize(colors)
+            bbox_colors = self.palette[entries]
+
+        # The crop follows from the grids, so the output size is known before any row is rendered
+        (char_width, char_height), atlas, origin = self.glyphs()
+        num_rows, num_cols = indices.shape
+        out_shape = (self.scale * char_height * num_rows, char_width * num_cols)
+        fill = None if self.color else 255 - self.bg_color
+        left, top, right, bottom = grid_bbox(indices, bbox_colors, atlas, origin, out_shape, self.bg_color, fill) or (
+            0, 0, out_shape[1], out_shape[0])
+        writer = open_image_writer(path, right - left, bottom - top, 3 if self.color else 1)
+
+        # Render the cell rows of each strip along with the rows whose glyphs reach into it, then keep its own rows
+        for first in range(0, num_rows, strip_rows):
+            last = min(first + strip_rows, num_rows)
+            out_top = max(first * char_height, top)
+            out_bottom = min(last * char_height, bottom) if last < num_rows else bottom
+            if out_top >= out_bottom:
+                continue
+            band = self.render_band(self.render_grid, indices, colors, out_shape, first, last)
+            offset = first * char_height
+            writer.write(band[out_top - offset:out_bottom - offset, left:right])
+        writer.close()
+
+    def write_text_tiled(self, reader, output_file, strip_rows=64):
+        # Text output strip by strip, writing the lines of each strip before the next one is read; equalizing needs
+        # the brightness of the whole image first, which is small enough to keep
+        grids = ((cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY) if strip.ndim == 3 else strip, geometry, edges)
+                 for strip, geometry, edges in self.strips(reader, strip_rows))
+        brightness = (cell_means(strip, *geometry, edges)[0] for strip, geometry, edges in grids)
+        if self.equalize:
+            brightness = [np.concatenate(list(brightness))]
+        for part in brightness:
+            for line in grid_to_lines(self.map(part), self.char_list):
+                output_file.write(line + "\n")
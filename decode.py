@@ -0,0 +1,114 @@
+import io
+import struct
+import sys
+import cv2
+import numpy as np
+from sources import PIPE
+
+# Reductions a JPEG decoder applies while decoding, scaling the DCT blocks down instead of the decoded image. Decoding
+# at 1/8 keeps only the DC coefficient of each block and changes one character in eight however wide the cells are, so
+# JPEGs are reduced by 4 at most.
+REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4}
+
+# Fewest reduced pixels a cell may span across. A reduced pixel is about the mean of its block, but cell edges snap to
+# whole blocks, so cell averages move a little and cells near the brightness step between two characters change to the
+# neighbouring one. With img2txt's 70 characters on data/input.jpg, decoding at 1/2 or 1/4 changes 4 to 12% of the
+# characters from 25 to 240 columns, 98% of them or more to a neighbour, cell means moving 0.2 to 0.5 levels on
+# average and at most 9. With 4 pixels, 18 to 25% changed. Video frames of data/input.mp4 at 8 to 12 pixels per
+# cell change about 4% of the characters, by under half a level.
+MIN_CELL_PIXELS = 8
+
+
+def jpeg_size(file):
+    # Height and width from the frame header of a JPEG file object, without decoding it; None for other formats
+    if file.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        kind = marker[1]
+        # Markers may be padded with any number of fill bytes
+        while kind == 0xFF:
+            kind = (file.read(1) or b"\0")[0]
+        if kind == 0x01 or 0xD0 <= kind <= 0xD8:
+            continue
+        header = file.read(2)
+        if len(header) < 2:
+            return None
+        length, = struct.unpack(">H", header)
+        # Start of frame markers, leaving out the huffman and arithmetic coding tables that share their range
+        if 0xC0 <= kind <= 0xCF and kind not in (0xC4, 0xC8, 0xCC):
+            _, height, width = struct.unpack(">BHH", file.read(5))
+            return height, width
+        file.seek(length - 2, io.SEEK_CUR)
+
+
+def reduction(width, num_cols, min_cell_pixels=MIN_CELL_PIXELS, largest=8):
+    # Largest factor of 2, 4 or 8, up to largest, that leaves cells of width / num_cols pixels at least min_cell_pixels
+    # wide; characters are at least as high as wide, so the width bounds both dimensions
+    factor = 1
+    while factor < largest and width / num_cols / (2 * factor) >= min_cell_pixels:
+        factor *= 2
+    return factor
+
+
+def decode_flags(size, num_cols):
+    # imread flags decoding a JPEG of size (height, width) small enough for a grid of num_cols columns
+    factor = reduction(size[1], num_cols, largest=max(REDUCED_FLAGS)) if size else 1
+    return REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR)
+
+
+def frame_reductions(width, widths):
+    # Reduction of decoded frames shared by every grid width, and the further reduction of each width's own frame,
+    # so every width is converted from the frame a conversion of it alone would use. Reducing a reduced frame again
+    # rounds twice, so frames are only shared when every width allows the same reduction.
+    factors = [reduction(width, num_cols) for num_cols in widths]
+    common = factors[0] if len(set(factors)) == 1 else 1
+    return common, [factor // common for factor in factors]
+
+
+def read_image(path, num_cols):
+    # Decode an image for a grid of num_cols columns; JPEGs are decoded at the largest reduction the cells allow.
+    # PIPE reads the encoded image from standard input.
+    return read_images(path, [num_cols])[0]
+
+
+def read_images(path, widths):
+    # read_image for every grid width, decoding the image once per reduction the widths need; widths of the same
+    # reduction get the same image
+    if path == PIPE:
+        buffer = sys.stdin.buffer.read()
+        size = jpeg_size(io.BytesIO(buffer))
+        decode = lambda flag: cv2.imdecode(np.frombuffer(buffer, np.uint8), flag)
+    else:
+        with open(path, "rb") as file:
+            size = jpeg_size(file)
+        decode = lambda flag: cv2.imread(path, flag)
+    flags = [decode_flags(size, num_cols) for num_cols in widths]
+    images = {flag: decode(flag) for flag in dict.fromkeys(flags)}
+    if any(image is None for image in images.values()):
+        raise ValueError(f"Cannot read {'standard input' if path == PIPE else path}")
+    return [images[flag] for flag in flags]
+
+
+def decode_image(buffer, num_cols):
+    # read_image for the bytes of an encoded image
+    size = jpeg_size(io.BytesIO(buffer))
+    return cv2.imdecode(np.frombuffer(buffer, np.uint8), decode_flags(size, num_cols))
+
+
+def reduce_frame(frame, factor):
+    # Average factor x factor blocks of a decoded video frame, dropping the last rows and columns that do not fill a
+    # block, so each pixel is the exact mean of its block
+    if factor == 1:
+        return frame
+    height, width = frame.shape[:2]
+    frame = frame[:height - height % factor, :width - width % factor]
+    return cv2.resize(frame, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+
+
+def reduce_frames(frame, factors):
+    # reduce_frame by each of factors, reducing once per distinct factor
+    reduced = {factor: reduce_frame(frame, factor) for factor in dict.fromkeys(factors)}
+    return [reduced[factor] for factor in factors]
@@ -0,0 +1,348 @@
+import math
+import cv2
+import numpy as np
+
+
+def build_atlas(char_list, font, char_width, char_height):
+    from PIL import Image, ImageDraw
+
+    # Measure how far glyphs reach outside their (char_width x char_height) cell, in whole cells
+    boxes = [font.getbbox(char) for char in char_list]
+    top = max(0, math.ceil(-min(box[1] for box in boxes) / char_height))
+    left = max(0, math.ceil(-min(box[0] for box in boxes) / char_width))
+    bottom = max(0, math.ceil(max(box[3] for box in boxes) / char_height) - 1)
+    right = max(0, math.ceil(max(box[2] for box in boxes) / char_width) - 1)
+    blocks_y, blocks_x = top + 1 + bottom, left + 1 + right
+
+    # Rasterize every character once into a tile of blocks_y x blocks_x cells
+    atlas = np.zeros((len(char_list), blocks_y * char_height, blocks_x * char_width), np.uint8)
+    for i, char in enumerate(char_list):
+        tile = Image.new("L", (blocks_x * char_width, blocks_y * char_height), 0)
+        ImageDraw.Draw(tile).text((left * char_width, top * char_height), char, fill=255, font=font)
+        atlas[i] = np.array(tile)
+
+    # Split tiles into cell-sized blocks: (blocks_y, blocks_x, num_chars, char_height, char_width)
+    atlas = atlas.reshape(len(char_list), blocks_y, char_height, blocks_x, char_width).transpose(1, 3, 0, 2, 4)
+    return np.ascontiguousarray(atlas), (top, left)
+
+
+def glyph_templates(atlas, origin, tile_shape, spread=50):
+    # Templates for match_tiles: every glyph's own cell averaged down to tile_shape, centered and normalized so only
+    # its shape counts, followed by a brightness coordinate. The brightness of glyph i is that of the cells
+    # luminance mode gives it, and a cell spread levels away costs as much as a shape that does not match at all.
+    (char_height, char_width), (tile_height, tile_width) = atlas.shape[3:], tile_shape
+    glyphs = atlas[origin].astype(np.float32)
+    if (tile_height, tile_width) != (char_height, char_width):
+        glyphs = np.stack([cv2.resize(glyph, (tile_width, tile_height), interpolation=cv2.INTER_AREA)
+                           for glyph in glyphs])
+    shapes = glyphs.reshape(len(glyphs), -1)
+    levels = (np.arange(len(glyphs), dtype=np.float32) + 0.5) * 255 / len(glyphs)
+
+    # Ink stands for bright cell pixels when the character list runs from light to dense glyphs, and for dark
+    # ones when it runs from dense to light like the ranked sets
+    ink = shapes.mean(axis=1)
+    if ink.std() > 0 and np.corrcoef(ink, levels)[0, 1] < 0:
+        shapes = -shapes
+    shapes = shapes - shapes.mean(axis=1, keepdims=True)
+    shapes /= np.maximum(np.linalg.norm(shapes, axis=1, keepdims=True), 1e-6)
+
+    # Expanding -(mean - level)^2 / spread^2 leaves 2 * mean * level / spread^2 and a bias of -level^2 / spread^2
+    templates = np.hstack([shapes, 2 * levels[:, None] / spread ** 2]).astype(np.float32)
+    return templates, -(levels / spread) ** 2
+
+
+def gather_block(indices, block):
+    # Assemble one block of every cell's glyph into a (rows * char_height, cols * char_width) frame
+    rows, cols = indices.shape
+    _, char_height, char_width = block.shape
+    return block[indices].transpose(0, 2, 1, 3).reshape(rows * char_height, cols * char_width)
+
+
+def block_slices(offset_y, offset_x, layer_shape, out_shape):
+    # Destination and source slices of a layer shifted by (offset_y, offset_x) and clipped to the output
+    dst_y, src_y = max(offset_y, 0), max(-offset_y, 0)
+    dst_x, src_x = max(offset_x, 0), max(-offset_x, 0)
+    size_y = min(layer_shape[0] - src_y, out_shape[0] - dst_y)
+    size_x = min(layer_shape[1] - src_x, out_shape[1] - dst_x)
+    if size_y <= 0 or size_x <= 0:
+        return None, None
+    return ((slice(dst_y, dst_y + size_y), slice(dst_x, dst_x + size_x)),
+            (slice(src_y, src_y + size_y), slice(src_x, src_x + size_x)))
+
+
+def div255(tmp):
+    # Rounded division by 255 of values below 65280, computed in place without a real division
+    tmp += 128
+    tmp += tmp >> 8
+    tmp >>= 8
+    return tmp.astype(np.uint8)
+
+
+def blend(out, ink, mask):
+    # Same rounding as PIL's mask blending: (out * (255 - mask) + ink * mask) / 255
+    mask = mask.astype(np.uint16)
+    tmp = out.astype(np.uint16)
+    tmp *= 255 - mask
+    tmp += mask * np.asarray(ink, np.uint16)
+    return div255(tmp)
+
+
+def screen(mask, layer):
+    # Combine overlapping glyph coverage within one string the way the font renderer does
+    tmp = mask.astype(np.uint16)
+    tmp *= layer
+    return mask + layer - div255(tmp)
+
+
+def render_lines(indices, atlas, origin, out_shape, fill, bg_color):
+    # Render a character grid the way draw.text draws it one row string at a time
+    out = np.full(out_shape, bg_color, np.uint8)
+    blocks_y, blocks_x, _, char_height, char_width = atlas.shape
+    top, left = origin
+
+    # Rows are drawn top to bottom, so blocks reaching further down come from earlier rows
+    for block_y in range(blocks_y - 1, -1, -1):
+        # Glyphs of the same row string are merged into one mask before it is blended
+        mask = np.zeros(out_shape, np.uint8)
+        for block_x in range(blocks_x):
+            layer = gather_block(indices, atlas[block_y, block_x])
+            dst, src = block_slices((block_y - top) * char_height, (block_x - left) * char_width, layer.shape,
+                                    out_shape)
+            if dst is not None:
+                mask[dst] = screen(mask[dst], layer[src]) if block_x else layer[src]
+        out = blend(out, fill, mask)
+
+    return out
+
+
+def render_cells(indices, colors, atlas, origin, out_shape, bg_color, out=None):
+    # Render a character grid the way draw.text draws it one cell at a time, each in its own color,
+    # into out when a buffer of the right shape is given
+    if out is None:
+        out = np.empty(out_shape + (len(bg_color),), np.uint8)
+    out[:] = np.tile(np.asarray(bg_color, np.uint8), (out_shape[1], 1))
+    blocks_y, blocks_x, _, char_height, char_width = atlas.shape
+    top, left = origin
+    rows, cols = indices.shape
+    colors = colors.astype(np.uint8)
+
+    # Cells are drawn row by row, left to right, so blocks reaching further down and right come from earlier cells
+    for block_y in range(blocks_y - 1, -1, -1):
+        for block_x in range(blocks_x - 1, -1, -1):
+            offset_y, offset_x = (block_y - top) * char_height, (block_x - left) * char_width
+            if offset_y == 0 and offset_x == 0:
+                # Blend every cell's glyph mask in its color over the frame in one expression
+                mask = atlas[block_y, block_x][indices].transpose(0, 2, 1, 3)[..., None]
+                grid = out[:rows * char_height, :cols * char_width].reshape(rows, char_height, cols, char_width, -1)
+                out[:rows * char_height, :cols * char_width] = blend(grid, colors[:, None, :, None], mask).reshape(
+                    rows * char_height, cols * char_width, -1)
+                continue
+
+            # Parts of glyphs reaching into neighbouring cells are rare, so only their inked pixels are blended
+            block = atlas[block_y, block_x]
+            cell_ys, cell_xs = np.nonzero(block.any(axis=(1, 2))[indices])
+            tiles = block[indices[cell_ys, cell_xs]]
+            cell, tile_ys, tile_xs = np.nonzero(tiles)
+            out_ys = cell_ys[cell] * char_height + offset_y + tile_ys
+            out_xs = cell_xs[cell] * char_width + offset_x + tile_xs
+            inside = (out_ys >= 0) & (out_ys < out_shape[0]) & (out_xs >= 0) & (out_xs < out_shape[1])
+            cell, tile_ys, tile_xs = cell[inside], tile_ys[inside], tile_xs[inside]
+            pixels = out.reshape(-1, out.shape[2])
+            flat = out_ys[inside] * out_shape[1] + out_xs[inside]
+            pixels[flat] = blend(pixels[flat], colors[cell_ys[cell], cell_xs[cell]],
+                                 tiles[cell, tile_ys, tile_xs][:, None])
+
+    return out
+
+
+def render_indexed(indices, entries, atlas, origin, out_shape, shades):
+    # Render a character grid colored by palette entry as an index image for shade_table: 0 where there is no ink,
+    # entry * shades + shade where a glyph covers the pixel, its coverage rounded to one of shades steps. Only
+    # coverage and entry are gathered per pixel, so every color is drawn in the same few array operations.
+    blocks_y, blocks_x, _, char_height, char_width = atlas.shape
+    top, left = origin
+    rows, cols = indices.shape
+    coverage = np.zeros(out_shape, np.uint8)
+    owner = np.zeros(out_shape, np.uint8)
+    entries = entries.astype(np.uint8)
+    coverage[:rows * char_height, :cols * char_width] = gather_block(indices, atlas[top, left])
+    owner[:rows * char_height, :cols * char_width] = np.broadcast_to(
+        entries[:, None, :, None], (rows, char_height, cols, char_width)).reshape(rows * char_height, -1)
+
+    # Parts of glyphs reaching into neighbouring cells are rare, so only their inked pixels are looked at; where
+    # glyphs overlap, the one covering the pixel most gives it its color
+    for block_y in range(blocks_y):
+        for block_x in range(blocks_x):
+            if (block_y, block_x) == (top, left):
+                continue
+            block = atlas[block_y, block_x]
+            cell_ys, cell_xs = np.nonzero(block.any(axis=(1, 2))[indices])
+            tiles = block[indices[cell_ys, cell_xs]]
+            cell, tile_ys, tile_xs = np.nonzero(tiles)
+            out_ys = cell_ys[cell] * char_height + (block_y - top) * char_height + tile_ys
+            out_xs = cell_xs[cell] * char_width + (block_x - left) * char_width + tile_xs
+            inside = (out_ys >= 0) & (out_ys < out_shape[0]) & (out_xs >= 0) & (out_xs < out_shape[1])
+            flat = out_ys[inside] * out_shape[1] + out_xs[inside]
+            values = tiles[cell, tile_ys, tile_xs][inside]
+            stronger = values > coverage.ravel()[flat]
+            coverage.ravel()[flat[stronger]] = values[stronger]
+            owner.ravel()[flat[stronger]] = entries[cell_ys[cell], cell_xs[cell]][inside][stronger]
+
+    shade = cv2.LUT(coverage, ((np.arange(256) * shades + 127) // 255).astype(np.uint8))
+    owner *= shades
+    owner += shade
+    owner[shade == 0] = 0
+    return owner
+
+
+def content_bbox(out, bg_color):
+    # Bounding box of pixels differing from the background, as PIL's getbbox reports it
+    channels = out.shape[2] if out.ndim == 3 else 1
+    content = out.reshape(out.shape[0], -1) ^ np.tile(np.asarray(bg_color, np.uint8), out.shape[1])
+    rows = np.flatnonzero(content.max(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(content[rows[0]:rows[-1] + 1].max(axis=0).reshape(-1, channels).max(axis=1))
+    return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+
+def affected_cells(dirty, atlas, origin, grid_shape):
+    # Cell regions of the frame reached by any glyph block drawn from a dirty cell
+    top, left = origin
+    affected = np.zeros(grid_shape, bool)
+    for block_y, block_x in zip(*np.nonzero(atlas.any(axis=(2, 3, 4)))):
+        dst, src = block_slices(block_y - top, block_x - left, dirty.shape, grid_shape)
+        if dst is not None:
+            affected[dst] |= dirty[src]
+    return np.nonzero(affected)
+
+
+def redraw_cells(out, cell_ys, cell_xs, indices, atlas, origin, bg_color, colors=None, fill=None):
+    # Recomposite whole cell regions of a rendered frame in place, in the same order a full render draws them
+    rows, cols = indices.shape
+    blocks_y, blocks_x, _, char_height, char_width = atlas.shape
+    top, left = origin
+    tiles = np.empty((len(cell_ys), char_height, char_width) + out.shape[2:], np.uint8)
+    tiles[:] = np.asarray(bg_color, np.uint8)
+
+    for block_y in range(blocks_y - 1, -1, -1):
+        line_mask = np.zeros(tiles.shape[:3], np.uint8)
+        for block_x in range(blocks_x - 1, -1, -1):
+            # Find the cell whose glyph reaches each region through this block, skipping glyphs without ink there
+            block = atlas[block_y, block_x]
+            src_ys, src_xs = cell_ys - (block_y - top), cell_xs - (block_x - left)
+            inked = np.flatnonzero((src_ys >= 0) & (src_ys < rows) & (src_xs >= 0) & (src_xs < cols))
+            inked = inked[block.any(axis=(1, 2))[indices[src_ys[inked], src_xs[inked]]]]
+            mask = block[indices[src_ys[inked], src_xs[inked]]]
+
+            if colors is None:
+                line_mask[inked] = screen(line_mask[inked], mask)
+            else:
+                ink = colors[src_ys[inked], src_xs[inked]][:, None, None]
+                tiles[inked] = blend(tiles[inked], ink, mask[..., None])
+
+        # Row strings are blended as one mask per row, like render_lines does
+        if colors is None:
+            tiles = blend(tiles, fill, line_mask)
+
+    grid = out.reshape(out.shape[0] // char_height, char_height, out.shape[1] // char_width, char_width, -1)
+    grid[cell_ys, :, cell_xs] = tiles.reshape(tiles.shape[:3] + (-1,))
+
+
+def render_incremental(state, indices, atlas, origin, out_shape, bg_color, colors=None, fill=None, tolerance=0):
+    # Render the first frame in full and keep its character and color grids
+    if colors is not None:
+        colors = colors.astype(np.uint8)
+    if "out" not in state or state["indices"].shape != indices.shape:
+        if colors is None:
+            state["out"] = render_lines(indices, atlas, origin, out_shape, fill, bg_color)
+        else:
+            state["out"] = render_cells(indices, colors, atlas, origin, out_shape, bg_color)
+        state["indices"], state["colors"] = indices.copy(), colors
+        return state["out"], 1.0
+
+    # A cell is dirty when its character changed or its color moved further than the tolerance
+    dirty = indices != state["indices"]
+    if colors is not None:
+        dirty |= np.abs(colors.astype(np.int16) - state["colors"]).max(axis=2) > tolerance
+
+    # Re-render only the regions the dirty cells' glyphs reach; unchanged frames skip rendering entirely
+    if dirty.any():
+        state["indices"][dirty] = indices[dirty]
+        if colors is not None:
+            state["colors"][dirty] = colors[dirty]
+        grid_shape = (out_shape[0] // atlas.shape[3], out_shape[1] // atlas.shape[4])
+        cell_ys, cell_xs = affected_cells(dirty, atlas, origin, grid_shape)
+
+        # Past about half of the frame a full render is cheaper than redrawing cell by cell
+        if len(cell_ys) > dirty.size // 2:
+            if colors is None:
+                state["out"] = render_lines(state["indices"], atlas, origin, out_shape, fill, bg_color)
+            else:
+                state["out"] = render_cells(state["indices"], state["colors"], atlas, origin, out_shape, bg_color)
+        else:
+            redraw_cells(state["out"], cell_ys, cell_xs, state["indices"], atlas, origin, bg_color, state["colors"],
+                         fill)
+
+    return state["out"], dirty.mean()
+
+
+def grid_bbox(indices, colors, atlas, origin, out_shape, bg_color, fill=None):
+    # Bounding box of the pixels rendering the grid would change, worked out from glyph coverage without rendering.
+    # A pixel leaves the background once coverage * |ink - background| reaches 128, where the rounded blend moves it.
+    blocks_y, blocks_x, num_chars, char_height, char_width = atlas.shape
+    top, left = origin
+    tiles = atlas.transpose(2, 0, 3, 1, 4).reshape(num_chars, blocks_y * char_height, blocks_x * char_width)
+    rows, cols = indices.shape
+    if colors is None:
+        strength = np.full(indices.shape, abs(int(fill) - int(bg_color)))
+    else:
+        strength = np.abs(colors.astype(np.uint8).astype(np.int16) - np.asarray(bg_color, np.int16)).max(axis=2)
+    threshold = np.where(strength > 0, -(-128 // np.maximum(strength, 1)), 256)
+
+    # Glyph tiles are clipped at the frame edges, so cells are grouped by the part of their tile that is visible
+    tile_ys = (np.arange(rows) - top) * char_height
+    tile_xs = (np.arange(cols) - left) * char_width
+    y_windows = np.stack([np.maximum(0, -tile_ys), np.minimum(tiles.shape[1], out_shape[0] - tile_ys)], axis=1)
+    x_windows = np.stack([np.maximum(0, -tile_xs), np.minimum(tiles.shape[2], out_shape[1] - tile_xs)], axis=1)
+    bbox = [out_shape[1], out_shape[0], 0, 0]
+    for y_lo, y_hi in np.unique(y_windows, axis=0):
+        for x_lo, x_hi in np.unique(x_windows, axis=0):
+            if y_lo >= y_hi or x_lo >= x_hi:
+                continue
+            cell_ys = np.flatnonzero((y_windows == (y_lo, y_hi)).all(axis=1))
+            cell_xs = np.flatnonzero((x_windows == (x_lo, x_hi)).all(axis=1))
+            visible = tiles[:, y_lo:y_hi, x_lo:x_hi]
+            chars = indices[np.ix_(cell_ys, cell_xs)].ravel()
+            needed = threshold[np.ix_(cell_ys, cell_xs)].ravel()[:, None]
+
+            # Rows and columns of every cell's glyph holding enough coverage to show
+            shown_rows = visible.max(axis=2)[chars] >= needed
+            shown_cols = visible.max(axis=1)[chars] >= needed
+            inked = shown_rows.any(axis=1)
+            if not inked.any():
+                continue
+            ys = np.repeat(tile_ys[cell_ys], len(cell_xs))[inked] + y_lo
+            xs = np.tile(tile_xs[cell_xs], len(cell_ys))[inked] + x_lo
+            shown_rows, shown_cols = shown_rows[inked], shown_cols[inked]
+            bbox[0] = min(bbox[0], (xs + shown_cols.argmax(axis=1)).min())
+            bbox[1] = min(bbox[1], (ys + shown_rows.argmax(axis=1)).min())
+            bbox[2] = max(bbox[2], (xs + shown_cols.shape[1] - shown_cols[:, ::-1].argmax(axis=1)).max())
+            bbox[3] = max(bbox[3], (ys + shown_rows.shape[1] - shown_rows[:, ::-1].argmax(axis=1)).max())
+
+    return None if bbox[2] == 0 else tuple(int(value) for value in bbox)
+
+
+def grid_extent(atlas, origin, grid_shape, out_shape):
+    # Bounding box of every pixel some glyph could ink in a grid of this shape, whatever its characters; frames
+    # cropped to it keep one size
+    blocks_y, blocks_x, num_chars, char_height, char_width = atlas.shape
+    top, left = origin
+    rows, cols = grid_shape
+    inked = atlas.any(axis=2).transpose(0, 2, 1, 3).reshape(blocks_y * char_height, blocks_x * char_width)
+    ys, xs = np.flatnonzero(inked.any(axis=1)), np.flatnonzero(inked.any(axis=0))
+    if len(ys) == 0:
+        return 0, 0, out_shape[1], out_shape[0]
+    return (int(max(0, xs[0] - left * char_width)), int(max(0, ys[0] - top * char_height)),
+            int(min(out_shape[1], (cols - 1 - left) * char_width + xs[-1] + 1)),
+            int(min(out_shape[0], (rows - 1 - top) * char_height + ys[-1] + 1)))
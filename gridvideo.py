@@ -0,0 +1,249 @@
+import argparse
+import json
+import struct
+import sys
+import time
+import zlib
+import cv2
+import numpy as np
+from PIL import ImageFont
+from converter import AsciiConverter
+from terminal import frame_escapes, terminal_colors
+
+# Extension of grid videos, which the video converters write instead of an mp4 when the output ends with it
+EXTENSION = ".asv"
+
+# File layout: magic, header length and JSON header, compressed frames, frame index, then the trailer
+MAGIC = b"ASCIIVID"
+INDEX_MAGIC = b"ASCIIIDX"
+TRAILER = struct.Struct("<QI8s")
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("size", "<u4"), ("key", "u1")])
+
+
+def quantize(colors, bits):
+    # Keep the top bits of every channel of the truncated cell colors
+    return colors.astype(np.uint8) >> (8 - bits)
+
+
+def dequantize(levels, bits):
+    # Spread quantized levels back over the full 0 to 255 range
+    top = (1 << bits) - 1
+    return ((levels.astype(np.uint16) * 255 + top // 2) // top).astype(np.uint8)
+
+
+def encode_header(header):
+    # Magic, header length and the JSON header that start every grid video
+    encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return MAGIC + struct.pack("<I", len(encoded)) + encoded
+
+
+class GridVideoWriter:
+    # Writes character grids and quantized color grids as keyframes and XOR delta frames, zlib compressed
+
+    def __init__(self, path, converter, fps, color_bits=5, keyframe_interval=60):
+        self.file = open(path, "wb")
+        self.converter = converter
+        self.fps = fps
+        self.color_bits = color_bits
+        self.keyframe_interval = keyframe_interval
+        self.index = []
+        self.previous = None
+        self.header_written = False
+
+    def write_header(self, grid_shape):
+        # Everything needed to render the frames again: characters, font, geometry and timing
+        font = self.converter.font
+        header = {
+            "version": 1,
+            "char_list": self.converter.char_list,
+            "font": font.path if font else None,
+            "font_size": font.size if font else None,
+            "sample_char": self.converter.sample_char,
+            "scale": self.converter.scale,
+            "background": self.converter.background,
+            "color": self.converter.color,
+            "color_bits": self.color_bits,
+            "fps": self.fps,
+            "rows": grid_shape[0],
+            "cols": grid_shape[1],
+        }
+        self.file.write(encode_header(header))
+        self.header_written = True
+
+    def write(self, indices, colors=None):
+        # One frame as raw bytes: the character grid, followed by the quantized color grid in color
+        if not self.header_written:
+            self.write_header(indices.shape)
+        payload = indices.astype(np.uint8).ravel()
+        if self.converter.color:
+            payload = np.concatenate([payload, quantize(colors, self.color_bits).ravel()])
+
+        # Keyframes are compressed as they are; delta frames store what changed, mostly zero runs
+        key = self.previous is None or len(self.index) % self.keyframe_interval == 0
+        if key:
+            data = zlib.compress(payload.tobytes(), 6)
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, 8, zlib.Z_RLE)
+            data = compressor.compress((payload ^ self.previous).tobytes()) + compressor.flush()
+        self.index.append((self.file.tell(), len(data), key))
+        self.file.write(data)
+        self.previous = payload
+
+    def close(self):
+        # The frame index goes last, so frames can be written as they come and still be found by number
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, INDEX_DTYPE).tobytes())
+        self.file.write(TRAILER.pack(index_offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GridVideoReader:
+    # Reads frames by number, decoding from the nearest keyframe and rendering only the frames asked for
+
+    def __init__(self, path, fixed_frame=False):
+        self.file = open(path, "rb")
+        self.fixed_frame = fixed_frame
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an ASCII grid video")
+        header_size, = struct.unpack("<I", self.file.read(4))
+        self.header = json.loads(self.file.read(header_size).decode("utf-8"))
+
+        self.file.seek(-TRAILER.size, 2)
+        index_offset, frame_count, index_magic = TRAILER.unpack(self.file.read(TRAILER.size))
+        if index_magic != INDEX_MAGIC:
+            raise ValueError(f"{path} has no frame index, it was not closed properly")
+        self.file.seek(index_offset)
+        self.index = np.frombuffer(self.file.read(frame_count * INDEX_DTYPE.itemsize), INDEX_DTYPE)
+        self.keyframes = np.flatnonzero(self.index["key"])
+
+        self.cells = self.header["rows"] * self.header["cols"]
+        self.converter = None
+        self.position, self.payload = -1, None
+
+    def __len__(self):
+        return len(self.index)
+
+    def payload_at(self, frame_idx):
+        # Continue from the last decoded frame when possible, otherwise start at the closest keyframe before
+        if not 0 <= frame_idx < len(self.index):
+            raise IndexError(f"frame {frame_idx} out of range")
+        keyframe = self.keyframes[np.searchsorted(self.keyframes, frame_idx, side="right") - 1]
+        if not keyframe <= self.position <= frame_idx:
+            self.position = keyframe - 1
+
+        while self.position < frame_idx:
+            self.position += 1
+            offset, size, key = self.index[self.position]
+            self.file.seek(offset)
+            data = np.frombuffer(zlib.decompress(self.file.read(size)), np.uint8)
+            self.payload = data if key else self.payload ^ data
+        return self.payload
+
+    def frame(self, frame_idx):
+        # Character grid and, in color, the BGR color grid of one frame
+        payload = self.payload_at(frame_idx)
+        shape = self.header["rows"], self.header["cols"]
+        indices = payload[:self.cells].reshape(shape).astype(np.int64)
+        if not self.header["color"]:
+            return indices, None
+        return indices, dequantize(payload[self.cells:].reshape(shape + (3,)), self.header["color_bits"])
+
+    def render(self, frame_idx):
+        # Render one frame with the font it was converted with, loading the font on first use
+        if self.converter is None:
+            header = self.header
+            self.converter = AsciiConverter(char_list=header["char_list"],
+                                            font=ImageFont.truetype(header["font"], size=header["font_size"]),
+                                            sample_char=header["sample_char"], scale=header["scale"],
+                                            color=header["color"], background=header["background"],
+                                            fixed_frame=self.fixed_frame)
+        return self.converter.render(*self.frame(frame_idx))
+
+    def close(self):
+        self.file.close()
+
+
+def concatenate(paths, path):
+    # Join grid videos of consecutive time segments by copying their compressed frames; every part starts with a
+    # keyframe, so no frame has to be decoded or compressed again
+    readers = [GridVideoReader(part) for part in paths]
+    header = readers[0].header
+    if any(reader.header != header for reader in readers):
+        raise ValueError("Grid videos to join were converted with different settings")
+    index = []
+    with open(path, "wb") as file:
+        file.write(encode_header(header))
+        for reader in readers:
+            for offset, size, key in reader.index:
+                reader.file.seek(offset)
+                index.append((file.tell(), size, key))
+                file.write(reader.file.read(size))
+            reader.close()
+        index_offset = file.tell()
+        file.write(np.array(index, INDEX_DTYPE).tobytes())
+        file.write(TRAILER.pack(index_offset, len(index), INDEX_MAGIC))
+
+
+def get_args():
+    # Set up argument parser for command line inputs
+    parser = argparse.ArgumentParser("ASCII grid video player")
+    parser.add_argument("input", type=str, help="Path to a grid video written by the video converters")
+    parser.add_argument("--frame", type=int, default=None, help="Render only this frame")
+    parser.add_argument("--output", type=str, default=None, help="Image or video file to render to")
+    parser.add_argument("--start", type=int, default=0, help="First frame to play or render")
+    parser.add_argument("--color_mode", type=str, default="truecolor", choices=["truecolor", "256"],
+                        help="Terminal colors used when playing")
+    return parser.parse_args()
+
+
+def play(reader, start=0, color_mode="truecolor", output=sys.stdout.buffer):
+    # Show frames in the terminal at their frame rate, writing only the cells that change
+    fps = reader.header["fps"] or 30
+    previous = {"color_mode": color_mode}
+    output.write(b"\x1b[?25l\x1b[2J")
+    begin = time.perf_counter()
+    try:
+        for frame_idx in range(start, len(reader)):
+            indices, colors = reader.frame(frame_idx)
+            if colors is None:
+                colors = np.full(indices.shape + (3,), 0 if reader.header["background"] == "white" else 255, np.uint8)
+            output.write(frame_escapes(indices, terminal_colors(colors[..., ::-1], color_mode),
+                                       reader.header["char_list"], previous))
+            output.flush()
+            delay = begin + (frame_idx - start + 1) / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        output.write(f"\x1b[0m\x1b[{reader.header['rows'] + 1};1H\x1b[?25h".encode())
+        output.flush()
+
+
+if __name__ == '__main__':
+    options = get_args()
+    # Frames rendered into a video keep one size
+    reader = GridVideoReader(options.input, fixed_frame=options.frame is None and bool(options.output))
+    if options.frame is not None:
+        # A single frame, straight from its keyframe
+        cv2.imwrite(options.output or "frame.png", reader.render(options.frame))
+    elif options.output:
+        # Render the frames into a regular video
+        writer = None
+        for frame_idx in range(options.start, len(reader)):
+            image = reader.render(frame_idx)
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            if writer is None:
+                writer = cv2.VideoWriter(options.output, cv2.VideoWriter_fourcc(*"mp4v"), reader.header["fps"],
+                                         (image.shape[1], image.shape[0]))
+            writer.write(image)
+        if writer:
+            writer.release()
+    else:
+        play(reader, options.start, options.color_mode)
+    reader.close()
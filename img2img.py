@@ -1,82 +1,88 @@
 import argparse
-import cv2
-import numpy as np
-from PIL import Image, ImageDraw, ImageOps
+import sys
+from PIL import Image
 import os
-from utils import get_data
+from converter import AsciiConverter, shared_frames
+from decode import read_images
+from sources import PIPE
+from utils import sized_output
 
 
-def get_args():
-    # Set up argument parser for command line inputs
+def get_args(argv=None):
+    # Set up argument parser for command line inputs, or for argv when given
     parser = argparse.ArgumentParser("Image to ASCII")
-    parser.add_argument("--input", type=str, default="data/input.jpg", help="Path to input image")
-    parser.add_argument("--output", type=str, default="img_output.jpg", help="Path to output image")
+    parser.add_argument("--input", type=str, default="data/input.jpg",
+                        help="Path to input image, or - to read it from standard input")
+    parser.add_argument("--output", type=str, default="img_output.jpg",
+                        help="Path to output image, or - to write it to standard output as PNG")
     parser.add_argument("--language", type=str, default="english")
     parser.add_argument("--mode", type=str, default="standard")
+    parser.add_argument("--rebuild_cache", action="store_true",
+                        help="Re-rank the character set instead of using the cache")
     parser.add_argument("--background", type=str, default="black", choices=["black", "white"],
                         help="Background color for output image")
-    parser.add_argument("--num_cols", type=int, default=600, help="Number of characters for output's width")
-    args = parser.parse_args()
-    return args
+    parser.add_argument("--num_cols", type=int, nargs="+", default=[600],
+                        help="Number of characters for output's width; several widths are written from one decode, "
+                             "or one per JPEG reduction they need, each output named with its width")
+    parser.add_argument("--gamma", type=float, default=1.0,
+                        help="Gamma applied to cell brightness before choosing characters, above 1 darkens mid tones")
+    parser.add_argument("--equalize", action="store_true",
+                        help="Spread cell brightness over the whole character set with histogram equalization")
+    parser.add_argument("--match", type=str, default="luminance", choices=["luminance", "shape"],
+                        help="Choose characters by cell brightness, or by how closely their glyph matches the cell")
+    parser.add_argument("--strip_rows", type=int, default=0,
+                        help="Convert the image this many cell rows at a time to bound memory, 0 to convert it whole")
+    parser.add_argument("--batch", type=str, default=None,
+                        help="Directory or glob of input images to convert instead of --input")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes converting images in parallel")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads rendering one image, each a horizontal band of its cell rows")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Record of converted files used to resume a batch, named after --output by default")
+    return parser.parse_args(argv)
+
+
+def make_converter(options, num_cols):
+    # Convert with the character set and font of the language and mode
+    return AsciiConverter(options.language, options.mode, num_cols, background=options.background,
+                          rebuild_cache=options.rebuild_cache,
+                          gamma=options.gamma, equalize=options.equalize, match=options.match,
+                          threads=options.threads)
 
 
 def execute_conversion(options):
     # Create results directory if it doesn't exist
     os.makedirs("results", exist_ok=True)
-
-    # Determine background color based on user input
-    bg_color = 255 if options.background == "white" else 0
-
-    # Get character set and font based on language and mode
-    char_list, font, sample_character, scale = get_data(options.language, options.mode)
-    num_chars = len(char_list)
-    num_cols = options.num_cols
-
-    # Read and preprocess the input image
-    image = cv2.imread(options.input)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width = image.shape
-
-    # Calculate cell dimensions for ASCII representation
-    cell_width = width / num_cols
-    cell_height = scale * cell_width
-    num_rows = int(height / cell_height)
-
-    # Adjust cell dimensions if they exceed image dimensions
-    if num_cols > width or num_rows > height:
-        print("Too many columns or rows. Using default settings.")
-        cell_width = 6
-        cell_height = 12
-        num_cols = int(width / cell_width)
-        num_rows = int(height / cell_height)
-
-    # Get character dimensions for drawing
-    char_bbox = font.getbbox(sample_character)
-    char_width, char_height = char_bbox[2], char_bbox[3]
-
-    # Create a new image for the output
-    out_width = char_width * num_cols
-    out_height = scale * char_height * num_rows
-    out_image = Image.new("L", (out_width, out_height), bg_color)
-
-    draw = ImageDraw.Draw(out_image)
-
-    # Loop through each cell to calculate average brightness and draw characters
-    for i in range(num_rows):
-        line = "".join([char_list[min(int(np.mean(image[int(i * cell_height):min(int((i + 1) * cell_height), height),
-                                                  int(j * cell_width):min(int((j + 1) * cell_width),
-                                                                          width)]) / 255 * num_chars), num_chars - 1)]
-                        for j in range(num_cols)]) + "\n"
-        draw.text((0, i * char_height), line, fill=255 - bg_color, font=font)
-
-    # Crop the output image based on background color
-    cropped_area = out_image.getbbox() if options.background == "black" else ImageOps.invert(out_image).getbbox()
-    out_image = out_image.crop(cropped_area)
-
-    # Save the final output image
-    out_image.save(os.path.join("results", options.output))
+    converters = [make_converter(options, num_cols) for num_cols in options.num_cols]
+    outputs = [os.path.join("results", sized_output(options.output, num_cols, options.num_cols))
+               for num_cols in options.num_cols]
+    if options.output == PIPE and len(outputs) > 1:
+        raise ValueError("Standard output carries the image of a single --num_cols")
+
+    # Huge images are read, rendered and written a strip at a time, once per width
+    if options.strip_rows:
+        from tiles import StripReader
+        for converter, output in zip(converters, outputs):
+            converter.convert_tiled(StripReader(options.input, converter.num_cols), output, options.strip_rows)
+        return
+
+    # Widths of the same JPEG reduction are converted from the same decoded image
+    frames = shared_frames(converters, read_images(options.input, options.num_cols))
+    for converter, output, (image, table) in zip(converters, outputs, frames):
+        out_image = Image.fromarray(converter.convert_frame(image, table=table), "L")
+
+        # Save the final output image, as PNG on standard output for -
+        if options.output == PIPE:
+            out_image.save(sys.stdout.buffer, "PNG")
+        else:
+            out_image.save(output)
 
 
 if __name__ == '__main__':
     options = get_args()
-    execute_conversion(options)
\ No newline at end of file
+    if options.batch:
+        from batch import run_batch
+        from utils import get_data
+        run_batch(execute_conversion, options, get_data, (options.language, options.mode))
+    else:
+        execute_conversion(options)
@@ -1,86 +1,112 @@
 import argparse
+import sys
 import cv2
-import numpy as np
-from PIL import Image, ImageDraw, ImageOps
-from utils import get_data
+from PIL import Image
+from converter import AsciiConverter, shared_frames
+from decode import read_images
+from markup import MARKUP_FORMATS
+from sources import PIPE
+from utils import sized_output, palette_option
 import os
 
 
-def parse_arguments():
-    # Set up argument parser for command line inputs
+def parse_arguments(argv=None):
+    # Set up argument parser for command line inputs, or for argv when given
     parser = argparse.ArgumentParser("Image to ASCII")
-    parser.add_argument("--input", type=str, default="data/input.jpg", help="Path to input image")
-    parser.add_argument("--output", type=str, default="img_color_output.jpg", help="Path to output image")
+    parser.add_argument("--input", type=str, default="data/input.jpg",
+                        help="Path to input image, or - to read it from standard input")
+    parser.add_argument("--output", type=str, default="img_color_output.jpg",
+                        help="Path to output image, .html or .svg for colored text, or - to write it to standard "
+                             "output as PNG")
     parser.add_argument("--language", type=str, default="korean")
     parser.add_argument("--mode", type=str, default="standard")
+    parser.add_argument("--rebuild_cache", action="store_true",
+                        help="Re-rank the character set instead of using the cache")
     parser.add_argument("--background", type=str, default="black", choices=["black", "white"],
                         help="Background color for output image")
-    parser.add_argument("--num_cols", type=int, default=200, help="Number of characters for output's width")
+    parser.add_argument("--num_cols", type=int, nargs="+", default=[200],
+                        help="Number of characters for output's width; several widths are written from one decode, "
+                             "or one per JPEG reduction they need, each output named with its width")
+    parser.add_argument("--gamma", type=float, default=1.0,
+                        help="Gamma applied to cell brightness before choosing characters, above 1 darkens mid tones")
+    parser.add_argument("--equalize", action="store_true",
+                        help="Spread cell brightness over the whole character set with histogram equalization")
+    parser.add_argument("--match", type=str, default="luminance", choices=["luminance", "shape"],
+                        help="Choose characters by cell brightness, or by how closely their glyph matches the cell")
+    parser.add_argument("--palette", type=palette_option, default=None,
+                        help="Quantize cell colors to this many colors fitted to the image, or to the xterm 256-color "
+                             "palette with ansi; .png and .gif output is then saved as an indexed image")
     parser.add_argument("--scale", type=int, default=2, help="Upsize output")
-    return parser.parse_args()
+    parser.add_argument("--strip_rows", type=int, default=0,
+                        help="Convert the image this many cell rows at a time to bound memory, 0 to convert it whole")
+    parser.add_argument("--batch", type=str, default=None,
+                        help="Directory or glob of input images to convert instead of --input")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes converting images in parallel")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads rendering one image, each a horizontal band of its cell rows")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Record of converted files used to resume a batch, named after --output by default")
+    return parser.parse_args(argv)
+
+
+def make_converter(options, num_cols):
+    # Convert with the character set and font of the language and mode
+    return AsciiConverter(options.language, options.mode, num_cols, color=True,
+                          background=options.background, rebuild_cache=options.rebuild_cache,
+                          gamma=options.gamma, equalize=options.equalize, match=options.match,
+                          palette=options.palette, threads=options.threads)
 
 
 def execute_conversion(options):
     # Create results directory if it doesn't exist
     os.makedirs("results", exist_ok=True)
 
-    # Determine background color based on user input
-    bg_color = (255, 255, 255) if options.background == "white" else (0, 0, 0)
-
-    # Get character set and font based on language and mode
-    characters, font, sample_char, scale_factor = get_data(options.language, options.mode)
-    total_chars = len(characters)
-    cols = options.num_cols
-
-    # Read and preprocess the input image
-    img = cv2.imread(options.input, cv2.IMREAD_COLOR)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img_height, img_width, _ = img.shape
-
-    # Calculate cell dimensions for ASCII representation
-    cell_w = img_width / options.num_cols
-    cell_h = scale_factor * cell_w
-    rows = int(img_height / cell_h)
-
-    # Adjust cell dimensions if they exceed image dimensions
-    if cols > img_width or rows > img_height:
-        print("Too many columns or rows. Using default settings.")
-        cell_w, cell_h = 6, 12
-        cols = int(img_width / cell_w)
-        rows = int(img_height / cell_h)
-
-    # Get character dimensions for drawing
-    char_bbox = font.getbbox(sample_char)
-    char_w, char_h = char_bbox[2], char_bbox[3]
-
-    # Create a new image for the output
-    output_w = char_w * cols
-    output_h = scale_factor * char_h * rows
-    output_img = Image.new("RGB", (output_w, output_h), bg_color)
-    draw = ImageDraw.Draw(output_img)
-
-    # Loop through each cell to calculate average color and draw characters
-    for row in range(rows):
-        for col in range(cols):
-            partial_img = img[int(row * cell_h):min(int((row + 1) * cell_h), img_height),
-                            int(col * cell_w):min(int((col + 1) * cell_w), img_width), :]
-
-            # Calculate average color for the current cell
-            avg_color = np.sum(np.sum(partial_img, axis=0), axis=0) / (cell_h * cell_w)
-            avg_color = tuple(avg_color.astype(np.int32).tolist())
-
-            # Determine the character to draw based on average brightness
-            char = characters[min(int(np.mean(partial_img) * total_chars / 255), total_chars - 1)]
-            draw.text((col * char_w, row * char_h), char, fill=avg_color, font=font)
-
-    # Crop the output image based on background color
-    cropped_area = output_img.getbbox() if options.background == "black" else ImageOps.invert(output_img).getbbox()
-    output_img = output_img.crop(cropped_area)
-
-    # Save the final output image
-    output_img.save(os.path.join("results", options.output))
+    converters = [make_converter(options, num_cols) for num_cols in options.num_cols]
+    outputs = [os.path.join("results", sized_output(options.output, num_cols, options.num_cols))
+               for num_cols in options.num_cols]
+    if options.output == PIPE and len(outputs) > 1:
+        raise ValueError("Standard output carries the image of a single --num_cols")
+
+    # Huge images are read, rendered and written a strip at a time, once per width
+    if options.strip_rows:
+        from tiles import StripReader
+        for converter, output in zip(converters, outputs):
+            converter.convert_tiled(StripReader(options.input, converter.num_cols), output, options.strip_rows)
+        return
+
+    # Convert the image in BGR like every other input of the converter, widths of the same JPEG reduction from the
+    # same decoded image
+    frames = shared_frames(converters, read_images(options.input, options.num_cols))
+    extension = ".png" if options.output == PIPE else os.path.splitext(options.output)[1].lower()
+    indexed = options.palette and extension in (".png", ".gif")
+    for converter, output, (image, table) in zip(converters, outputs, frames):
+        if extension in MARKUP_FORMATS:
+            # Colored text instead of an image, each run of equally colored cells in one element
+            with open(output, "w", encoding="utf-8") as file:
+                converter.convert_markup(image, file, MARKUP_FORMATS[extension], table)
+            continue
+        if indexed:
+            # One byte per pixel into the palette shades, which PNG and GIF store as they are
+            index_img, colors = converter.convert_indexed(image, table)
+            output_img = Image.fromarray(index_img, "P")
+            output_img.putpalette(colors[:, ::-1].tobytes())
+        else:
+            # Saved in RGB
+            output_img = Image.fromarray(cv2.cvtColor(converter.convert_frame(image, table=table), cv2.COLOR_BGR2RGB),
+                                         "RGB")
+
+        # Save the final output image, as PNG on standard output for -
+        if options.output == PIPE:
+            output_img.save(sys.stdout.buffer, "PNG")
+        else:
+            output_img.save(output)
 
 
 if __name__ == '__main__':
     options = parse_arguments()
-    execute_conversion(options)
+    if options.batch:
+        from batch import run_batch
+        from utils import get_data
+        run_batch(execute_conversion, options, get_data, (options.language, options.mode))
+    else:
+        execute_conversion(options)
@@ -1,63 +1,78 @@
 import argparse
-import cv2
-import numpy as np
-from utils import get_data
+import contextlib
+import sys
+from converter import AsciiConverter, shared_frames
+from decode import read_images
+from sources import PIPE
+from utils import sized_output
 import os
 
 
-def get_args():
-    # Set up argument parser for command line inputs
+def get_args(argv=None):
+    # Set up argument parser for command line inputs, or for argv when given
     parser = argparse.ArgumentParser("Image to ASCII")
-    parser.add_argument("--input", type=str, default="data/input.jpg", help="Path to input image")
-    parser.add_argument("--output", type=str, default="txt_output.txt", help="Path to output text file")
+    parser.add_argument("--input", type=str, default="data/input.jpg",
+                        help="Path to input image, or - to read it from standard input")
+    parser.add_argument("--output", type=str, default="txt_output.txt",
+                        help="Path to output text file, or - to write it to standard output")
     parser.add_argument("--mode", type=str, default="complex", choices=["simple", "complex"],
                         help="10 or 70 different characters")
-    parser.add_argument("--num_cols", type=int, default=200, help="Number of characters for output's width")
-    return parser.parse_args()
+    parser.add_argument("--num_cols", type=int, nargs="+", default=[200],
+                        help="Number of characters for output's width; several widths are written from one decode, "
+                             "or one per JPEG reduction they need, each output named with its width")
+    parser.add_argument("--gamma", type=float, default=1.0,
+                        help="Gamma applied to cell brightness before choosing characters, above 1 darkens mid tones")
+    parser.add_argument("--equalize", action="store_true",
+                        help="Spread cell brightness over the whole character set with histogram equalization")
+    parser.add_argument("--strip_rows", type=int, default=0,
+                        help="Convert the image this many cell rows at a time to bound memory, 0 to convert it whole")
+    parser.add_argument("--batch", type=str, default=None,
+                        help="Directory or glob of input images to convert instead of --input")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes converting images in parallel")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Record of converted files used to resume a batch, named after --output by default")
+    return parser.parse_args(argv)
 
 
-def execute_conversion(options):
-    # Create results directory if it doesn't exist
-    os.makedirs("results", exist_ok=True)
-
+def make_converter(options, num_cols):
     # Define character sets based on the selected mode
     if options.mode == "simple":
         CHAR_LIST = '@%#*+=-:. '
     else:
         CHAR_LIST = r"$@B%8&WM#*oahkbdpqwmZO0QLCJUYXzcvunxrjft/\|()1{}[]?-_+~<>i!lI;:,\"^`'. "
     
-    num_chars = len(CHAR_LIST)
-    image = cv2.imread(options.input)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width = image.shape
-
-    # Calculate cell dimensions for ASCII representation
-    cell_width = width / options.num_cols
-    cell_height = 2 * cell_width
-    num_rows = int(height / cell_height)
-
-    # Adjust cell dimensions if they exceed image dimensions
-    if options.num_cols > width or num_rows > height:
-        print("Too many columns or rows. Using default settings.")
-        cell_width = 6
-        cell_height = 12
-        options.num_cols = int(width / cell_width)
-        num_rows = int(height / cell_height)
-
-    # Open output file to write ASCII characters
-    with open(os.path.join("results", options.output), 'w') as output_file:
-        for i in range(num_rows):
-            for j in range(options.num_cols):
-                # Calculate average brightness for the current cell
-                avg_brightness = np.mean(image[int(i * cell_height):min(int((i + 1) * cell_height), height),
-                                                int(j * cell_width):min(int((j + 1) * cell_width), width)])
-                
-                # Determine the character to write based on brightness
-                char_index = min(int(avg_brightness * num_chars / 255), num_chars - 1)
-                output_file.write(CHAR_LIST[char_index])
-            output_file.write("\n")
+    return AsciiConverter(char_list=CHAR_LIST, num_cols=num_cols,
+                          gamma=options.gamma, equalize=options.equalize)
+
+
+def execute_conversion(options):
+    # Create results directory if it doesn't exist
+    os.makedirs("results", exist_ok=True)
+    converters = [make_converter(options, num_cols) for num_cols in options.num_cols]
+    if options.output == PIPE and len(converters) > 1:
+        raise ValueError("Standard output carries the text of a single --num_cols")
+
+    # Widths of the same JPEG reduction are converted from the same decoded image, unless it is read a strip at a time
+    frames = [(None, None)] * len(converters)
+    if not options.strip_rows:
+        frames = shared_frames(converters, read_images(options.input, options.num_cols))
+    for converter, num_cols, (image, table) in zip(converters, options.num_cols, frames):
+        # Open output file to write ASCII characters, or write them to standard output for -
+        output = os.path.join("results", sized_output(options.output, num_cols, options.num_cols))
+        with contextlib.nullcontext(sys.stdout) if options.output == PIPE else open(output, 'w') as output_file:
+            if options.strip_rows:
+                # Write the lines of each strip before reading the next one
+                from tiles import StripReader
+                converter.write_text_tiled(StripReader(options.input, num_cols), output_file,
+                                           options.strip_rows)
+            else:
+                output_file.write(converter.convert_text(image, table))
 
 
 if __name__ == '__main__':
     options = get_args()
-    execute_conversion(options)
\ No newline at end of file
+    if options.batch:
+        from batch import run_batch
+        run_batch(execute_conversion, options)
+    else:
+        execute_conversion(options)
@@ -0,0 +1,117 @@
+import html
+import itertools
+import numpy as np
+
+# Colored text formats, by output extension
+MARKUP_FORMATS = {".html": "html", ".htm": "html", ".svg": "svg"}
+
+# Levels per channel of colors without a palette, the 16 of CSS three-digit colors: cells merge when their colors
+# are written the same, at most 8 levels per channel away from the cell average
+COLOR_LEVELS = 16
+
+# Letters of the color table's class names; the colors of the most runs get the shortest names
+CLASS_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def class_names(count):
+    # count CSS class names: a to z, then aa, ab and so on
+    names = (("".join(letters) for letters in itertools.product(CLASS_LETTERS, repeat=length))
+             for length in itertools.count(1))
+    return list(itertools.islice(itertools.chain.from_iterable(names), count))
+
+
+def hex_color(bgr):
+    # CSS color of a BGR color, in its three-digit form when there is one
+    text = "".join(f"{int(channel):02x}" for channel in bgr[::-1])
+    if text[0::2] == text[1::2]:
+        text = text[0::2]
+    return "#" + text
+
+
+def run_keys(indices, keys, char_list):
+    # Color key of every cell, blank cells taking the key of the visible cell before them in their row, or after
+    # them at the start of a row, since their color does not show and they can join either run
+    blank = np.array([char.isspace() for char in char_list])[indices]
+    num_cols = indices.shape[1]
+    columns = np.arange(num_cols)
+    before = np.maximum.accumulate(np.where(blank, -1, columns), axis=1)
+    after = np.minimum.accumulate(np.where(blank, num_cols, columns)[:, ::-1], axis=1)[:, ::-1]
+    source = np.where(before >= 0, before, np.minimum(after, num_cols - 1))
+    return np.take_along_axis(keys, source, axis=1)
+
+
+def color_keys(colors, entries=None, palette=None):
+    # One integer per cell that is equal for cells of equal color, and the BGR color of every key: palette entries
+    # with a palette, otherwise the nearest color of COLOR_LEVELS levels per channel
+    if entries is not None:
+        return entries.astype(np.int32), palette
+    step = 255 / (COLOR_LEVELS - 1)
+    levels = np.clip(np.round(colors / step), 0, COLOR_LEVELS - 1).astype(np.int32)
+    keys = (levels[..., 0] * COLOR_LEVELS + levels[..., 1]) * COLOR_LEVELS + levels[..., 2]
+    table = np.round(np.indices((COLOR_LEVELS,) * 3).reshape(3, -1).T * step).astype(np.uint8)
+    return keys, table
+
+
+def merged_runs(indices, keys, char_list):
+    # Runs of cells of equal key in every row as their row, start, end and class number, and the key of every class;
+    # classes are numbered by how many runs use them
+    keys = run_keys(indices, keys, char_list)
+    new_run = np.ones(keys.shape, bool)
+    new_run[:, 1:] = keys[:, 1:] != keys[:, :-1]
+    rows, starts = np.nonzero(new_run)
+    run_key = keys[rows, starts]
+    ends = np.append(starts[1:], 0)
+    ends[np.append(rows[1:] != rows[:-1], True)] = keys.shape[1]
+    used, counts = np.unique(run_key, return_counts=True)
+    ranking = np.argsort(-counts, kind="stable")
+    numbers = np.empty(len(used), np.int64)
+    numbers[ranking] = np.arange(len(used))
+    return rows, starts, ends, numbers[np.searchsorted(used, run_key)], used[ranking]
+
+
+def markup_rows(indices, char_list, runs, names, tag, quote=""):
+    # Markup of every row as it is produced: the row's escaped characters cut into one element per run
+    rows, starts, ends, classes = runs
+    escaped = [html.escape(char, quote=False) for char in char_list]
+    lengths = np.array([len(text) for text in escaped])
+    row_ends = np.searchsorted(rows, np.arange(indices.shape[0]), side="right")
+    first = 0
+    for row, last in enumerate(row_ends):
+        text = "".join([escaped[index] for index in indices[row]])
+        offsets = np.concatenate([[0], np.cumsum(lengths[indices[row]])])
+        yield "".join(f"<{tag} class={quote}{names[number]}{quote}>{text[offsets[start]:offsets[end]]}</{tag}>"
+                      for start, end, number in zip(starts[first:last].tolist(), ends[first:last].tolist(),
+                                                    classes[first:last].tolist()))
+        first = last
+
+
+def write_markup(file, kind, indices, keys, key_colors, char_list, font, cell_size, bg_color):
+    # Colored text of a character grid as HTML or SVG, one element per run of cells of equal color key, classes of
+    # a color table for the colors; the head goes out first and every row as soon as it is built
+    *runs, used = merged_runs(indices, keys, char_list)
+    names = class_names(len(used))
+    attribute = "color" if kind == "html" else "fill"
+    table = "".join(f".{name}{{{attribute}:{hex_color(key_colors[key])}}}" for name, key in zip(names, used))
+    family, _ = font.getname()
+    cell_width, cell_height = cell_size
+    font_css = f'{font.size}px/{cell_height}px "{family}",monospace'
+    background = hex_color(np.broadcast_to(bg_color, 3))
+
+    if kind == "html":
+        file.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><style>'
+                   f'body{{margin:0;background:{background}}}pre{{margin:0;font:{font_css}}}{table}'
+                   f'</style></head><body><pre>\n')
+        for line in markup_rows(indices, char_list, runs, names, "span"):
+            file.write(line + "\n")
+        file.write("</pre></body></html>\n")
+    else:
+        width, height = cell_width * indices.shape[1], cell_height * indices.shape[0]
+        file.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+                   f'viewBox="0 0 {width} {height}" xml:space="preserve"><style>'
+                   f'text{{font:{font_css};white-space:pre}}{table}</style>'
+                   f'<rect width="100%" height="100%" fill="{background}"/>\n')
+        # Baselines sit one ascent below the top of each row, where the raster renderer draws them
+        ascent, _ = font.getmetrics()
+        for row, line in enumerate(markup_rows(indices, char_list, runs, names, "tspan", '"')):
+            file.write(f'<text y="{row * cell_height + ascent}">{line}</text>\n')
+        file.write("</svg>\n")
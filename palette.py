@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+from terminal import CUBE_LEVELS
+
+# Bits per channel of the color cube that maps cell colors to palette entries, 32 levels of 8 per channel
+LOOKUP_BITS = 5
+
+# Most cell colors a palette is fitted to; more are sampled evenly, which changes the palette very little
+FIT_SAMPLES = 20000
+
+# Palette entries an indexed image can hold next to the background, with at least two coverage shades each
+MAX_ENTRIES = 255
+
+
+def ansi_palette():
+    # The color cube and gray ramp of the xterm 256-color palette, codes 16 to 255, in BGR
+    levels = CUBE_LEVELS[np.indices((6, 6, 6)).reshape(3, -1).T]
+    grays = np.repeat(8 + 10 * np.arange(24), 3).reshape(-1, 3)
+    return np.concatenate([levels, grays])[:, ::-1].astype(np.uint8)
+
+
+def fit_palette(colors, size):
+    # Palette of size colors fitted to the cell colors with k-means, seeded so the same input gives the same palette
+    colors = np.asarray(colors, np.float32).reshape(-1, 3)
+    if len(colors) > FIT_SAMPLES:
+        colors = colors[np.linspace(0, len(colors) - 1, FIT_SAMPLES).astype(int)]
+    size = max(1, min(size, MAX_ENTRIES, len(colors)))
+    cv2.setRNGSeed(0)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.5)
+    _, _, centers = cv2.kmeans(colors, size, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    return np.clip(np.round(centers), 0, 255).astype(np.uint8)
+
+
+def palette_lookup(palette):
+    # Nearest palette entry of every color of a coarse color cube, so cells are mapped with one table lookup
+    step = 1 << (8 - LOOKUP_BITS)
+    centers = np.indices((1 << LOOKUP_BITS,) * 3).reshape(3, -1).T * step + step // 2
+    entries = np.empty(len(centers), np.uint8)
+    palette = palette.astype(np.int32)
+    for start in range(0, len(centers), 4096):
+        part = centers[start:start + 4096]
+        entries[start:start + 4096] = ((part[:, None] - palette) ** 2).sum(axis=2).argmin(axis=1)
+    return entries.reshape((1 << LOOKUP_BITS,) * 3)
+
+
+def palette_entries(colors, lookup):
+    # Palette entry of every cell color
+    levels = colors.astype(np.uint8) >> (8 - LOOKUP_BITS)
+    return lookup[levels[..., 0], levels[..., 1], levels[..., 2]]
+
+
+def shade_table(palette, bg_color):
+    # Colors of an indexed image: the background first, then every palette entry blended over it at each coverage
+    # shade. Index entry * shades + shade, for shades from 1 to shades, draws a glyph pixel of that coverage.
+    shades = MAX_ENTRIES // len(palette)
+    alpha = np.arange(1, shades + 1) / shades
+    bg = np.asarray(bg_color, np.float64)
+    table = bg + alpha[None, :, None] * (palette[:, None].astype(np.float64) - bg)
+    return np.concatenate([bg[None], table.reshape(-1, 3)]).round().astype(np.uint8), shades
+
+
+def apply_shades(index_image, colors):
+    # BGR image of an index image, every channel looked up in its own 256-entry table
+    table = np.zeros((256, 1, 3), np.uint8)
+    table[:len(colors), 0] = colors
+    return cv2.LUT(cv2.merge([index_image] * 3), table)
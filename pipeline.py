@@ -0,0 +1,155 @@
+import math
+import queue
+import threading
+import time
+import cv2
+from collections import deque
+from multiprocessing import Pool
+from decode import reduce_frame
+from sources import PIPE, open_source
+
+# Per-process state of a pool worker, set once by init_worker
+_worker_convert = None
+_worker_settings = None
+
+
+def frame_selection(input_fps, output_fps, frame_count, start=0.0, end=None, max_frames=0):
+    # Source frames feeding the output: the first one, the source frames per output frame, and how many output frames
+    step = input_fps / output_fps if output_fps and input_fps else 1.0
+    first = int(round(start * input_fps))
+    count = None
+    if end is not None or frame_count > 0:
+        last = int(round(end * input_fps)) if end is not None else frame_count
+        if frame_count > 0:
+            last = min(last, frame_count)
+        count = max(0, math.ceil((last - first) / step))
+    if max_frames:
+        count = max_frames if count is None else min(count, max_frames)
+    return {"start": first, "step": step, "count": count}
+
+
+def shard_selection(selection, index, shards):
+    # The output frames of one of shards consecutive time segments of a selection, as output frame offset and count
+    if not 0 <= index < shards:
+        raise ValueError(f"There is no segment {index} of {shards}")
+    if selection["count"] is None:
+        raise ValueError("Sharding needs a known number of output frames; give --end or --max_frames")
+    first = selection["count"] * index // shards
+    return dict(selection, first=first, count=selection["count"] * (index + 1) // shards - first)
+
+
+def read_frames(cap, decode_times=None, start=0, step=1.0, count=None, first=0, reduction=1):
+    # Seek to the first frame, then decode only the source frame of each output frame, start + floor(k * step);
+    # frames in between are skipped with grab(), which demuxes them without converting them to images.
+    # A step below one repeats source frames so the output keeps the playback speed. A time segment of the
+    # output starts at output frame first, picking the same source frames as a run over the whole selection.
+    # Decoded frames are shrunk by reduction right away, before they are converted or sent to a worker.
+    position = start + int(first * step + 1e-9)
+    if position:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+    frame, frame_idx = None, 0
+    while cap.isOpened() and (count is None or frame_idx < count):
+        target = start + int((first + frame_idx) * step + 1e-9)
+        begin = time.perf_counter() if decode_times is not None else None
+        while position < target:
+            if not cap.grab():
+                return
+            position += 1
+        if position == target:
+            flag, frame = cap.read()
+            if not flag:
+                break
+            frame = reduce_frame(frame, reduction)
+            position += 1
+        if decode_times is not None:
+            decode_times.append(time.perf_counter() - begin)
+        yield frame
+        frame_idx += 1
+
+
+def sample_frames(path, source=None, start=0, step=1.0, count=None, samples=8, first=0, reduction=1):
+    # Up to samples source frames spread evenly over the selected output frames, read from a capture of their own
+    # opened with the source options of open_source; a pipe can only be read once, by the conversion
+    if path == PIPE:
+        return []
+    cap = open_source(path, **(source or {}))
+    positions = sorted({start + int((first + k * (count or 1) / samples) * step + 1e-9)
+                        for k in range(samples if count else 1)})
+    frames = []
+    for position in positions:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+        flag, frame = cap.read()
+        if flag:
+            frames.append(reduce_frame(frame, reduction))
+    cap.release()
+    return frames
+
+
+def prefetch(frames, depth=4):
+    # Pull frames from a generator on a background thread, up to depth frames ahead, so decoding overlaps
+    # conversion; OpenCV and file reads release the GIL. A depth of 0 reads them in line.
+    if depth <= 0:
+        yield from frames
+        return
+    ready = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for frame in frames:
+                ready.put((frame, None))
+                if stop.is_set():
+                    return
+            ready.put((None, StopIteration()))
+        except Exception as error:
+            ready.put((None, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            frame, error = ready.get()
+            if isinstance(error, StopIteration):
+                return
+            if error is not None:
+                raise error
+            yield frame
+    finally:
+        # Make room for a blocked producer and wait for it, so the capture is not read after it is released
+        stop.set()
+        while thread.is_alive():
+            try:
+                ready.get(timeout=0.05)
+            except queue.Empty:
+                pass
+
+
+def init_worker(convert, settings):
+    # Keep the conversion function and its settings in the worker so frames are the only per-task payload
+    global _worker_convert, _worker_settings
+    _worker_convert, _worker_settings = convert, settings
+
+
+def run_worker(frame):
+    return _worker_convert(frame, _worker_settings)
+
+
+def convert_frames(frames, convert, settings, workers=1, queue_size=0):
+    # Convert frames serially when no worker processes were asked for
+    if workers <= 1:
+        for frame in frames:
+            yield convert(frame, settings)
+        return
+
+    # Keep at most queue_size frames in flight, so a slow writer holds back the decoder and memory stays bounded
+    queue_size = queue_size or 2 * workers
+    with Pool(workers, initializer=init_worker, initargs=(convert, settings)) as pool:
+        pending = deque()
+        for frame in frames:
+            if len(pending) >= queue_size:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(run_worker, (frame,)))
+
+        # Hand back the remaining frames in submission order
+        while pending:
+            yield pending.popleft().get()
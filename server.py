@@ -0,0 +1,404 @@
+import argparse
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+import cv2
+import numpy as np
+import img2img
+import img2img_color
+import img2txt
+from decode import decode_image
+from markup import MARKUP_FORMATS
+
+# Converters served, one per image script, under /<script name>
+SCRIPTS = {"img2img": img2img, "img2img_color": img2img_color, "img2txt": img2txt}
+
+# Options that only make sense for files on disk, or that would let a request take more of the server's cores, so
+# requests cannot set them
+FILE_OPTIONS = ("input", "strip_rows", "batch", "workers", "manifest", "rebuild_cache", "threads")
+
+CONTENT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp",
+                 ".bmp": "image/bmp", ".gif": "image/gif", ".txt": "text/plain; charset=utf-8",
+                 ".html": "text/html; charset=utf-8", ".htm": "text/html; charset=utf-8", ".svg": "image/svg+xml"}
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+# Per-process converters of a pool worker, most recently used last
+_worker_converters = OrderedDict()
+WORKER_CONVERTERS = 16
+
+
+def get_args():
+    # Set up argument parser for command line inputs
+    parser = argparse.ArgumentParser("ASCII conversion server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Convert uploaded images over HTTP with warm fonts and charsets")
+    serve.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    serve.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    serve.add_argument("--workers", type=int, default=2, help="Number of processes converting images")
+    serve.add_argument("--max_in_flight", type=int, default=0,
+                       help="Requests accepted at once before answering 503, 0 for four per worker")
+    serve.add_argument("--batch_window", type=float, default=0.005,
+                       help="Seconds to wait for more small requests to send to a worker together")
+    serve.add_argument("--max_batch", type=int, default=8, help="Most requests sent to a worker together")
+    serve.add_argument("--small_bytes", type=int, default=256 * 1024,
+                       help="Uploads up to this size are batched, larger ones go to a worker on their own")
+    serve.add_argument("--max_body", type=int, default=32 * 1024 * 1024, help="Largest upload accepted, in bytes")
+    serve.add_argument("--warm", type=str, nargs="*", default=["img2img", "img2txt", "img2img_color"],
+                       help="Requests, as path and query, whose converters every worker prepares at startup")
+
+    client = commands.add_parser("client", help="Send an image to a running server and report latencies")
+    client.add_argument("--url", type=str, default="http://127.0.0.1:8000/img2img_color?language=english",
+                        help="Converter path and options of the requests")
+    client.add_argument("--input", type=str, default="data/input.jpg", help="Image to upload")
+    client.add_argument("--output", type=str, default=None, help="Where to save the last response")
+    client.add_argument("--requests", type=int, default=20, help="Number of requests to send")
+    client.add_argument("--concurrency", type=int, default=4, help="Requests sent at the same time")
+    client.add_argument("--compare_cli", type=int, default=0,
+                        help="Also run the script this many times as a separate process, like shelling out")
+    return parser.parse_args()
+
+
+def request_options(script, query):
+    # Options of a request as the script's own parser reads them; a key without a value is a flag
+    argv = []
+    for key, value in query:
+        if key in FILE_OPTIONS:
+            raise ValueError(f"option {key} cannot be set by a request")
+        if not key:
+            raise ValueError("options need a name")
+        if "help".startswith(key):
+            raise ValueError("help is not available to requests")
+        argv += [f"--{key}"] + ([value] if value else [])
+    module = SCRIPTS[script]
+    parse = getattr(module, "get_args", None) or module.parse_arguments
+    errors = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errors), contextlib.redirect_stdout(errors):
+            options, defaults = parse(argv), parse([])
+    except SystemExit:
+        lines = errors.getvalue().strip().splitlines()
+        raise ValueError(lines[-1] if lines else "invalid options")
+    except Exception as error:
+        raise ValueError(f"invalid options: {error}")
+    # Abbreviated option names are expanded by the parser, so the file options are checked again once parsed
+    for key in FILE_OPTIONS:
+        if getattr(options, key, None) != getattr(defaults, key, None):
+            raise ValueError(f"option {key} cannot be set by a request")
+    if len(options.num_cols) > 1:
+        raise ValueError("a request converts to one num_cols")
+    return options
+
+
+def worker_converter(script, options):
+    # Converters are kept per script and options, fonts, charsets and glyphs are kept per process
+    key = (script,) + tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                                   for name, value in vars(options).items() if name != "output"))
+    if key in _worker_converters:
+        _worker_converters.move_to_end(key)
+    else:
+        _worker_converters[key] = SCRIPTS[script].make_converter(options, options.num_cols[0])
+        if len(_worker_converters) > WORKER_CONVERTERS:
+            _worker_converters.popitem(last=False)
+    return _worker_converters[key]
+
+
+def warm_worker(requests):
+    # Load fonts and ranked charsets and rasterize glyphs before the first request arrives
+    for request in requests:
+        url = urlsplit(request)
+        script = url.path.strip("/")
+        try:
+            converter = worker_converter(script, request_options(script, parse_qsl(url.query, True)))
+            if converter.font is not None:
+                converter.glyphs()
+        except Exception as error:
+            print(f"Could not warm {request}: {type(error).__name__}: {error}", file=sys.stderr)
+
+
+def convert_one(script, options, data):
+    # Decode the upload, convert it and encode the result in the format of the output name
+    image = decode_image(data, options.num_cols[0])
+    if image is None:
+        raise ValueError("upload is not an image")
+    converter = worker_converter(script, options)
+    extension = os.path.splitext(options.output)[1].lower()
+    if script == "img2txt":
+        return CONTENT_TYPES[".txt"], converter.convert_text(image).encode("utf-8")
+    if converter.palette_size and converter.palette_size != "ansi":
+        # A fitted palette belongs to one upload
+        converter.palette = None
+    if extension in MARKUP_FORMATS:
+        if not converter.color:
+            raise ValueError(f"{extension} output needs img2img_color")
+        text = io.StringIO()
+        converter.convert_markup(image, text, MARKUP_FORMATS[extension])
+        return CONTENT_TYPES[extension], text.getvalue().encode("utf-8")
+    if extension not in CONTENT_TYPES or extension == ".txt":
+        raise ValueError(f"cannot write {extension or 'output without extension'} images")
+    if converter.palette_size:
+        # Palette output is indexed when the format can store it
+        if extension in (".png", ".gif"):
+            from PIL import Image
+            index_image, colors = converter.convert_indexed(image)
+            output = Image.fromarray(index_image, "P")
+            output.putpalette(colors[:, ::-1].tobytes())
+            buffer = io.BytesIO()
+            output.save(buffer, extension[1:])
+            return CONTENT_TYPES[extension], buffer.getvalue()
+    elif extension == ".gif":
+        raise ValueError("gif output needs a palette")
+    ok, encoded = cv2.imencode(extension, converter.convert_frame(image))
+    return CONTENT_TYPES[extension], encoded.tobytes()
+
+
+def convert_batch(batch):
+    # Runs in a pool worker: every request of the batch, each failing on its own
+    results = []
+    for script, options, data in batch:
+        start = time.perf_counter()
+        try:
+            content_type, body = convert_one(script, options, data)
+            status = 200
+        except ValueError as error:
+            status, content_type, body = 400, "text/plain; charset=utf-8", f"{error}\n".encode()
+        except Exception as error:
+            status, content_type, body = 500, "text/plain; charset=utf-8", f"{type(error).__name__}: {error}\n".encode()
+        results.append((status, content_type, body, time.perf_counter() - start))
+    return results
+
+
+class ConversionServer:
+    # Accepts uploads over HTTP, groups small ones arriving together into batches and hands batches to the pool
+
+    def __init__(self, options):
+        self.options = options
+        self.max_in_flight = options.max_in_flight or 4 * options.workers
+        self.pool = ProcessPoolExecutor(options.workers, initializer=warm_worker, initargs=(options.warm,))
+        self.queue = asyncio.Queue()
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)
+        self.counts = {"requests": 0, "converted": 0, "failed": 0, "rejected": 0, "batches": 0}
+
+    async def run(self):
+        # Start every worker now, so none of them loads fonts while a request waits
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, convert_batch, [])
+                               for _ in range(self.options.workers)])
+        batcher = asyncio.create_task(self.batch_requests())
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        server = await asyncio.start_server(self.handle, self.options.host, self.options.port)
+        print(f"Serving {', '.join('/' + script for script in SCRIPTS)} and /metrics on "
+              f"http://{self.options.host}:{self.options.port} with {self.options.workers} workers")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown(cancel_futures=True)
+
+    async def batch_requests(self):
+        # Small requests wait up to batch_window for others to share a worker task with; large ones go alone
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.options.batch_window
+            while len(batch[0][2]) <= self.options.small_bytes and len(batch) < self.options.max_batch:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if len(item[2]) > self.options.small_bytes:
+                    self.submit([item])
+                else:
+                    batch.append(item)
+            self.submit(batch)
+
+    def submit(self, batch):
+        # Resolve every request of the batch when its worker task finishes
+        self.counts["batches"] += 1
+        task = asyncio.get_running_loop().run_in_executor(
+            self.pool, convert_batch, [(script, options, data) for script, options, data, _, _ in batch])
+
+        def done(task):
+            if task.cancelled() or task.exception():
+                results = [(500, "text/plain", b"worker failed\n", 0.0)] * len(batch)
+            else:
+                results = task.result()
+            for (_, _, _, future, queued), result in zip(batch, results):
+                if not future.done():
+                    future.set_result((result, time.perf_counter() - queued, len(batch)))
+        task.add_done_callback(done)
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive: one request after another on the same connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > self.options.max_body:
+                    await self.respond(writer, 413, "text/plain", b"upload too large\n", close=True)
+                    break
+                data = await reader.readexactly(length) if length else b""
+                status, content_type, body, extra = await self.route(method, target, data)
+                close = headers.get("connection", "").lower() == "close"
+                await self.respond(writer, status, content_type, body, extra, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, data):
+        url = urlsplit(target)
+        script = url.path.strip("/")
+        if script == "metrics":
+            return 200, "application/json", json.dumps(self.metrics(), indent=2).encode(), {}
+        if script not in SCRIPTS:
+            return 404, "text/plain", f"no converter at {url.path}\n".encode(), {}
+        if method != "POST":
+            return 405, "text/plain", b"upload the image with POST\n", {}
+        self.counts["requests"] += 1
+        try:
+            options = request_options(script, parse_qsl(url.query, True))
+        except ValueError as error:
+            self.counts["failed"] += 1
+            return 400, "text/plain", f"{error}\n".encode(), {}
+
+        # Past the limit, answer right away instead of queueing without bound
+        if self.in_flight >= self.max_in_flight:
+            self.counts["rejected"] += 1
+            return 503, "text/plain", b"too many requests in flight\n", {"Retry-After": "1"}
+        self.in_flight += 1
+        try:
+            future = asyncio.get_running_loop().create_future()
+            queued = time.perf_counter()
+            await self.queue.put((script, options, data, future, queued))
+            (status, content_type, body, convert), total, batch_size = await future
+        finally:
+            self.in_flight -= 1
+
+        self.counts["converted" if status == 200 else "failed"] += 1
+        self.latencies.append((total - convert, convert, total, batch_size))
+        return status, content_type, body, {"X-Convert-Ms": f"{convert * 1000:.1f}",
+                                            "X-Total-Ms": f"{total * 1000:.1f}", "X-Batch-Size": str(batch_size)}
+
+    async def respond(self, writer, status, content_type, body, extra=None, close=False):
+        head = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}", f"Content-Type: {content_type}",
+                f"Content-Length: {len(body)}", "Connection: close" if close else "Connection: keep-alive"]
+        head += [f"{name}: {value}" for name, value in (extra or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    def metrics(self):
+        # Percentiles in milliseconds over the last requests: waiting for a worker, converting, and both
+        report = dict(self.counts, in_flight=self.in_flight, max_in_flight=self.max_in_flight)
+        if self.latencies:
+            values = np.array(self.latencies)
+            for column, name in enumerate(("wait", "convert", "total")):
+                p50, p90, p99 = np.percentile(values[:, column] * 1000, [50, 90, 99])
+                report[f"{name}_ms"] = {"p50": round(p50, 2), "p90": round(p90, 2), "p99": round(p99, 2)}
+            report["mean_batch_size"] = round(float(values[:, 3].mean()), 2)
+        return report
+
+
+def send(url, data):
+    # One upload on its own connection; returns status, headers, body and seconds
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=300)
+    connection.request("POST", url.path + ("?" + url.query if url.query else ""), data,
+                       {"Content-Type": "application/octet-stream", "Connection": "close"})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, dict(response.getheaders()), body, time.perf_counter() - start
+
+
+def run_client(options):
+    # Send the same image from several threads at once and report latency percentiles
+    url = urlsplit(options.url)
+    with open(options.input, "rb") as input_file:
+        data = input_file.read()
+    results, lock, remaining = [], threading.Lock(), [options.requests]
+
+    def sender():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            result = send(url, data)
+            with lock:
+                results.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=sender) for _ in range(options.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    statuses = [status for status, _, _, _ in results]
+    seconds = np.array([elapsed for status, _, _, elapsed in results if status == 200]) * 1000
+    print(f"{len(results)} requests in {wall:.2f}s, {len(results) / wall:.1f} requests/s, "
+          f"statuses {dict((status, statuses.count(status)) for status in sorted(set(statuses)))}")
+    if len(seconds):
+        p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+        print(f"latency ms: p50 {p50:.1f}, p90 {p90:.1f}, p99 {p99:.1f}, max {seconds.max():.1f}")
+    failed = [body for status, _, body, _ in results if status != 200]
+    if failed:
+        print(f"first error: {failed[0].decode(errors='replace').strip()}")
+    if options.output and results:
+        with open(options.output, "wb") as output_file:
+            output_file.write(results[-1][2])
+
+    # The same conversion as a fresh process per request, the way a web tier shelling out pays for it
+    if options.compare_cli:
+        script = url.path.strip("/")
+        argv = [argument for key, value in parse_qsl(url.query, True)
+                for argument in [f"--{key}"] + ([value] if value else [])]
+        extension = ".txt" if script == "img2txt" else ".png"
+        times = []
+        for _ in range(options.compare_cli):
+            begin = time.perf_counter()
+            subprocess.run([sys.executable, f"{script}.py"] + argv + ["--input", options.input, "--output",
+                            f"server_compare{extension}"], check=True, capture_output=True)
+            times.append((time.perf_counter() - begin) * 1000)
+        os.remove(os.path.join("results", f"server_compare{extension}"))
+        print(f"{script}.py as a process: p50 {np.percentile(times, 50):.1f} ms over {options.compare_cli} runs")
+
+
+if __name__ == '__main__':
+    options = get_args()
+    if options.command == "serve":
+        try:
+            asyncio.run(ConversionServer(options).run())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+    else:
+        run_client(options)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import subprocess
+import sys
+import gridvideo
+
+
+def shard_path(output, index, shards):
+    # Part file of one time segment, next to the output it is joined into
+    stem, extension = os.path.splitext(output)
+    return f"{stem}.part{index + 1}of{shards}{extension}"
+
+
+def convert_shards(script, argv, shards):
+    # Convert every time segment in a process of its own, all at once, with the same arguments otherwise
+    processes = [subprocess.Popen([sys.executable, script] + argv + ["--shard", str(index)])
+                 for index in range(shards)]
+    failed = [index for index, process in enumerate(processes) if process.wait()]
+    if failed:
+        raise RuntimeError(f"Segments {', '.join(str(index) for index in failed)} failed")
+
+
+def check_join(output):
+    # Fail before any segment is converted when the segments of output could not be joined afterwards
+    if not output.endswith(gridvideo.EXTENSION) and not shutil.which("ffmpeg"):
+        raise RuntimeError(f"Joining {output} without re-encoding needs ffmpeg on PATH, or {gridvideo.EXTENSION} "
+                           f"output")
+
+
+def join_shards(output, shards, directory="results"):
+    # Concatenate the part files of the segments into the output without decoding or encoding any frame
+    paths = [os.path.join(directory, shard_path(output, index, shards)) for index in range(shards)]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Segments not converted yet: {', '.join(missing)}")
+    check_join(output)
+    path = os.path.join(directory, output)
+    if output.endswith(gridvideo.EXTENSION):
+        gridvideo.concatenate(paths, path)
+    else:
+        # ffmpeg's concat demuxer copies the encoded packets of every part
+        listing = path + ".parts.txt"
+        with open(listing, "w", encoding="utf-8") as file:
+            file.writelines(f"file '{os.path.abspath(part)}'\n" for part in paths)
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listing, "-c",
+                        "copy", path], check=True)
+        os.remove(listing)
+    for part in paths:
+        os.remove(part)
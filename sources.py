@@ -0,0 +1,201 @@
+import glob
+import os
+import re
+import sys
+import cv2
+import numpy as np
+
+# Input or output path that stands for standard input or output, so conversion can sit in a pipe
+PIPE = "-"
+
+# Pixel formats of raw frames, named as ffmpeg's -pix_fmt names them: bytes per pixel and the conversion to BGR
+RAW_FORMATS = {
+    "bgr24": (3, None),
+    "rgb24": (3, cv2.COLOR_RGB2BGR),
+    "bgra": (4, cv2.COLOR_BGRA2BGR),
+    "rgba": (4, cv2.COLOR_RGBA2BGR),
+    "gray": (1, cv2.COLOR_GRAY2BGR),
+}
+
+# Frame rate of image sequences and raw frames, which do not store one
+DEFAULT_FPS = 30.0
+
+# Files an image sequence given as a directory is made of
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp", ".ppm", ".pgm")
+
+
+def parse_size(text):
+    # "WIDTHxHEIGHT" as (width, height)
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height)
+
+
+class FrameSource:
+    # The part of cv2.VideoCapture the converters use, named as it names them, over frames read by number.
+    # Subclasses give frame(index) and the properties of the frames.
+
+    def __init__(self, width, height, fps, count):
+        self.width, self.height, self.fps, self.count = width, height, fps, count
+        self.position = 0
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def get(self, prop):
+        return float({cv2.CAP_PROP_FPS: self.fps, cv2.CAP_PROP_FRAME_COUNT: self.count,
+                      cv2.CAP_PROP_FRAME_WIDTH: self.width, cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                      cv2.CAP_PROP_POS_FRAMES: self.position}.get(prop, 0))
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.position = min(max(int(value), 0), self.count)
+        return True
+
+    def grab(self):
+        if not self.opened or self.position >= self.count:
+            return False
+        self.position += 1
+        return True
+
+    def read(self):
+        if not self.opened or self.position >= self.count:
+            return False, None
+        frame = self.frame(self.position)
+        self.position += 1
+        return frame is not None, frame
+
+    def release(self):
+        self.opened = False
+
+
+class ImageSequence(FrameSource):
+    # Numbered images as frames: a directory of images, a glob such as frames/*.png, or a printf pattern such as
+    # frames/%05d.png, in the order of their numbers
+
+    def __init__(self, pattern, fps=DEFAULT_FPS):
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                     if name.lower().endswith(IMAGE_EXTENSIONS)]
+        elif "%" in pattern:
+            paths = glob.glob(re.sub(r"%0?\d*d", "*", glob.escape(pattern)))
+        else:
+            paths = glob.glob(pattern)
+        # Natural order, so frame10 follows frame9
+        self.paths = sorted(paths, key=lambda path: [int(part) if part.isdigit() else part
+                                                     for part in re.split(r"(\d+)", path)])
+        if not self.paths:
+            raise FileNotFoundError(f"No images match {pattern}")
+        first = cv2.imread(self.paths[0], cv2.IMREAD_COLOR)
+        if first is None:
+            raise ValueError(f"Cannot read {self.paths[0]}")
+        super().__init__(first.shape[1], first.shape[0], fps, len(self.paths))
+
+    def frame(self, index):
+        return cv2.imread(self.paths[index], cv2.IMREAD_COLOR)
+
+
+class GifSource(FrameSource):
+    # Frames of an animated GIF, composited as a viewer shows them, at the rate of their mean display time
+
+    def __init__(self, path, fps=0):
+        from PIL import Image
+        self.image = Image.open(path)
+        count = getattr(self.image, "n_frames", 1)
+        durations = []
+        for index in range(count):
+            self.image.seek(index)
+            durations.append(self.image.info.get("duration") or 100)
+        fps = fps or 1000 / np.mean(durations)
+        super().__init__(self.image.width, self.image.height, fps, count)
+
+    def frame(self, index):
+        self.image.seek(index)
+        return cv2.cvtColor(np.asarray(self.image.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+    def release(self):
+        super().release()
+        self.image.close()
+
+
+class RawSource(FrameSource):
+    # Raw frames of a known size and pixel format from a stream, such as ffmpeg -f rawvideo writing to a pipe.
+    # Their number is unknown until the stream ends, and seeking only skips ahead.
+
+    def __init__(self, stream, width, height, pixel_format="bgr24", fps=DEFAULT_FPS):
+        if pixel_format not in RAW_FORMATS:
+            raise ValueError(f"Unknown pixel format {pixel_format}, expected one of {', '.join(RAW_FORMATS)}")
+        super().__init__(width, height, fps, 0)
+        self.stream = stream
+        pixel_bytes, self.conversion = RAW_FORMATS[pixel_format]
+        self.shape = (height, width, pixel_bytes) if pixel_bytes > 1 else (height, width)
+        self.frame_bytes = width * height * pixel_bytes
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES or value < self.position:
+            return False
+        while self.position < value:
+            if not self.grab():
+                return False
+        return True
+
+    def read_bytes(self):
+        # The next frame's bytes, or None once the stream ends, dropping a partial last frame
+        data = bytearray(self.frame_bytes)
+        view, filled = memoryview(data), 0
+        while self.opened and filled < self.frame_bytes:
+            read = self.stream.readinto(view[filled:])
+            if not read:
+                self.opened = False
+                return None
+            filled += read
+        if not self.opened:
+            return None
+        self.position += 1
+        return data
+
+    def grab(self):
+        return self.read_bytes() is not None
+
+    def read(self):
+        data = self.read_bytes()
+        if data is None:
+            return False, None
+        frame = np.frombuffer(data, np.uint8).reshape(self.shape)
+        return True, frame if self.conversion is None else cv2.cvtColor(frame, self.conversion)
+
+
+class RawWriter:
+    # Writes frames as raw bgr24 to a stream, the counterpart of RawSource, with the methods of cv2.VideoWriter
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, frame):
+        self.stream.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.stream.flush()
+
+
+def open_source(path, size=None, pixel_format="bgr24", fps=0):
+    # Frames of a video file, an image sequence, an animated GIF, or raw frames on standard input when path is PIPE.
+    # An existing file is always read as a video or GIF, even when its name looks like a pattern.
+    if path == PIPE:
+        if size is None:
+            raise ValueError("Raw frames on standard input need their size, WIDTHxHEIGHT")
+        return RawSource(sys.stdin.buffer, *size, pixel_format, fps or DEFAULT_FPS)
+    if not os.path.isfile(path) and (os.path.isdir(path) or any(mark in path for mark in "%*?[")):
+        return ImageSequence(path, fps or DEFAULT_FPS)
+    if path.lower().endswith(".gif"):
+        return GifSource(path, fps)
+    return cv2.VideoCapture(path)
+
+
+def open_writer(output, fps, size):
+    # Raw frames on standard output for PIPE, otherwise an mp4 in results
+    if output == PIPE:
+        print(f"Writing {size[0]}x{size[1]} bgr24 frames at {fps:g} FPS to standard output", file=sys.stderr)
+        return RawWriter(sys.__stdout__.buffer)
+    return cv2.VideoWriter("results/" + output, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
@@ -0,0 +1,153 @@
+import sys
+import time
+import cv2
+import numpy as np
+
+# Channel levels of the 6x6x6 color cube in the xterm 256-color palette
+CUBE_LEVELS = np.array([0, 95, 135, 175, 215, 255])
+
+
+def ansi_256(colors):
+    # Nearest xterm 256-color code for every RGB color, from the color cube or the gray ramp
+    colors = colors.astype(np.int32)
+    levels = np.where(colors < 48, 0, np.where(colors < 115, 1, (colors - 35) // 40))
+    cube = 16 + 36 * levels[..., 0] + 6 * levels[..., 1] + levels[..., 2]
+    cube_error = ((CUBE_LEVELS[levels] - colors) ** 2).sum(axis=-1)
+
+    gray_level = np.clip((colors.mean(axis=-1).astype(np.int32) - 3) // 10, 0, 23)
+    gray_error = ((8 + 10 * gray_level[..., None] - colors) ** 2).sum(axis=-1)
+    return np.where(gray_error < cube_error, 232 + gray_level, cube)
+
+
+def terminal_colors(colors, color_mode):
+    # Colors as the terminal will show them: RGB for truecolor, a single palette code for 256 colors
+    if color_mode == "256":
+        return ansi_256(colors)[..., None]
+    return colors.astype(np.uint8)
+
+
+def digits(values, width):
+    # ASCII bytes of non-negative integers, zero padded to a fixed width
+    powers = 10 ** np.arange(width - 1, -1, -1)
+    return (values[..., None] // powers % 10 + 48).astype(np.uint8)
+
+
+def char_table(char_list):
+    # UTF-8 bytes of every character padded to a common width, with a mask of the bytes in use
+    encoded = [char.encode("utf-8") for char in char_list]
+    width = max(len(code) for code in encoded)
+    table = np.zeros((len(encoded), width), np.uint8)
+    used = np.zeros((len(encoded), width), bool)
+    for i, code in enumerate(encoded):
+        table[i, :len(code)] = np.frombuffer(code, np.uint8)
+        used[i, :len(code)] = True
+    return table, used
+
+
+def frame_escapes(indices, colors, char_list, previous, tolerance=0):
+    # Only cells whose character changed or whose color moved beyond the tolerance are written
+    changed = np.ones(indices.shape, bool)
+    if "indices" in previous:
+        changed = (indices != previous["indices"]) | (
+            np.abs(colors.astype(np.int16) - previous["colors"]).max(axis=2) > tolerance)
+        previous["indices"][changed] = indices[changed]
+        previous["colors"][changed] = colors[changed]
+    else:
+        previous["indices"], previous["colors"] = indices.copy(), colors.copy()
+        previous["chars"] = char_table(char_list)
+
+    cell_ys, cell_xs = np.nonzero(changed)
+    if len(cell_ys) == 0:
+        return b""
+    colors = colors[cell_ys, cell_xs]
+
+    # Every cell becomes a fixed-width record: cursor move, color switch and character
+    count = len(cell_ys)
+    esc = np.array([27, 91], np.uint8)
+    cursor = np.concatenate([np.broadcast_to(esc, (count, 2)), digits(cell_ys + 1, 3),
+                             np.full((count, 1), ord(";"), np.uint8), digits(cell_xs + 1, 3),
+                             np.full((count, 1), ord("H"), np.uint8)], axis=1)
+    if previous["color_mode"] == "256":
+        color = np.concatenate([np.broadcast_to(np.frombuffer(b"\x1b[38;5;", np.uint8), (count, 7)),
+                                digits(colors[:, 0], 3), np.full((count, 1), ord("m"), np.uint8)], axis=1)
+    else:
+        separator = np.full((count, 1), ord(";"), np.uint8)
+        color = np.concatenate([np.broadcast_to(np.frombuffer(b"\x1b[38;2;", np.uint8), (count, 7)),
+                                digits(colors[:, 0], 3), separator, digits(colors[:, 1], 3), separator,
+                                digits(colors[:, 2], 3), np.full((count, 1), ord("m"), np.uint8)], axis=1)
+    table, used = previous["chars"]
+    char_bytes, char_used = table[indices[cell_ys, cell_xs]], used[indices[cell_ys, cell_xs]]
+
+    # Keep the cursor move only at the start of a run of changed cells and the color switch only when it differs
+    new_run = np.ones(count, bool)
+    new_run[1:] = (cell_ys[1:] != cell_ys[:-1]) | (cell_xs[1:] != cell_xs[:-1] + 1)
+    new_color = np.ones(count, bool)
+    new_color[1:] = (colors[1:] != colors[:-1]).any(axis=1)
+    records = np.concatenate([cursor, color, char_bytes], axis=1)
+    keep = np.concatenate([np.repeat(new_run[:, None], cursor.shape[1], axis=1),
+                           np.repeat(new_color[:, None], color.shape[1], axis=1), char_used], axis=1)
+    return records[keep].tobytes()
+
+
+def play(cap, converter, fps, selection, reduction=1, color_mode="truecolor", tolerance=0, output=sys.stdout.buffer):
+    # Stream the selected frames to the terminal at the output frame rate, picking source frames the way read_frames
+    # does and shrinking them the same way, and dropping frames when conversion falls behind
+    from decode import reduce_frame
+
+    fps = fps or 30
+    start_frame, step, count = selection["start"], selection["step"], selection["count"]
+    first = selection.get("first", 0)
+    char_list = converter.char_list
+    previous = {"color_mode": color_mode}
+    tolerance = tolerance if color_mode == "truecolor" else 0
+    shown, dropped, frame_idx, num_rows = 0, 0, 0, 0
+    position = start_frame + int(first * step + 1e-9)
+    if position:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+
+    # Hide the cursor and clear the screen
+    output.write(b"\x1b[?25l\x1b[2J")
+    start = time.perf_counter()
+    try:
+        while cap.isOpened() and (count is None or frame_idx < count):
+            # Skip output frames whose display time has already passed; their source frames are never decoded
+            due = int((time.perf_counter() - start) * fps)
+            if count is not None:
+                due = min(due, count)
+            if frame_idx < due:
+                dropped += due - frame_idx
+                frame_idx = due
+                continue
+
+            # Grab the source frames up to this output frame's; a step below one shows the last frame again
+            target = start_frame + int((first + frame_idx) * step + 1e-9)
+            while position < target and cap.grab():
+                position += 1
+            if position < target:
+                break
+            if position == target:
+                flag, frame = cap.read()
+                if not flag:
+                    break
+                position += 1
+                frame = reduce_frame(reduce_frame(frame, selection.get("reduction", 1)), reduction)
+
+                # Reduce the frame to characters and colors, then emit only what changed
+                indices, colors = converter.cells(frame)
+                num_rows = indices.shape[0]
+                colors = terminal_colors(colors[..., ::-1], color_mode)
+                output.write(frame_escapes(indices, colors, char_list, previous, tolerance))
+                output.flush()
+            shown += 1
+            frame_idx += 1
+
+            # Wait until the next frame is due
+            delay = start + frame_idx / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        # Reset colors, move below the picture and show the cursor again
+        output.write(f"\x1b[0m\x1b[{num_rows + 1};1H\x1b[?25h".encode())
+        output.flush()
+
+    return shown, dropped, time.perf_counter() - start
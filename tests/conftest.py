@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The converters are flat modules in the repository root, imported the way the scripts import each other
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
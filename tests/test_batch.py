@@ -0,0 +1,37 @@
+import os
+from argparse import Namespace
+import pytest
+from batch import output_names, run_batch
+
+
+def write_input(options):
+    # Stand-in conversion that writes the input path to the output file
+    with open(os.path.join("results", options.output), "w", encoding="utf-8") as output_file:
+        output_file.write(options.input)
+
+
+def test_inputs_sharing_a_stem_get_their_own_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("inputs")
+    for name in ("a.jpg", "a.png", "b.jpg"):
+        open(os.path.join("inputs", name), "wb").close()
+    options = Namespace(batch="inputs", output="txt_output.txt", manifest=None, workers=1)
+    run_batch(write_input, options)
+
+    written = {}
+    for name in os.listdir("results"):
+        if name.endswith("txt_output.txt"):
+            with open(os.path.join("results", name), encoding="utf-8") as output_file:
+                written[name] = output_file.read()
+    assert written == {"a_jpg_txt_output.txt": os.path.join("inputs", "a.jpg"),
+                       "a_png_txt_output.txt": os.path.join("inputs", "a.png"),
+                       "b_txt_output.txt": os.path.join("inputs", "b.jpg")}
+
+
+def test_same_name_in_different_directories():
+    assert output_names(["x/a.jpg", "y/a.jpg"], "out.png") == ["x_a_jpg_out.png", "y_a_jpg_out.png"]
+
+
+def test_remaining_clash_fails():
+    with pytest.raises(ValueError):
+        output_names(["d/a.jpg", "d/a.png", "d/a_jpg.png"], "out.png")
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from converter import AsciiConverter, KEPT_SIZES
+
+
+def gradient(height, width):
+    # BGR test frame with every brightness across its width and a different color down its height
+    row = np.linspace(0, 255, width).astype(np.uint8)
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[..., 0] = row
+    frame[..., 1] = row[::-1]
+    frame[..., 2] = np.linspace(0, 255, height).astype(np.uint8)[:, None]
+    return frame
+
+
+def test_caches_stay_bounded_over_many_frame_sizes():
+    converter = AsciiConverter("english", "standard", num_cols=20, color=True, fixed_frame=True)
+    for height in range(40, 240, 10):
+        converter.convert_frame(gradient(height, 160))
+    assert len(converter._buffers) == 1
+    assert len(converter._layouts) == KEPT_SIZES
+    assert len(converter._crops) == KEPT_SIZES
+
+
+def test_evicted_size_converts_the_same_again():
+    converter = AsciiConverter("english", "standard", num_cols=20, color=True, match="shape")
+    first = converter.convert_frame(gradient(50, 160))
+    for height in range(60, 60 + 10 * KEPT_SIZES, 10):
+        converter.convert_frame(gradient(height, 160))
+    assert np.array_equal(converter.convert_frame(gradient(50, 160)), first)
+
+
+def moving_frames(count=6):
+    # Frames of a gradient with a bright square moving across it, so only some cells change between frames
+    frames = []
+    for step in range(count):
+        frame = gradient(120, 160)
+        frame[30:70, 10 + 20 * step:50 + 20 * step] = (40, 220, 250)
+        frames.append(frame)
+    return frames
+
+
+@pytest.mark.parametrize("palette", [8, "ansi"])
+def test_incremental_palette_frames_match_full_render(palette):
+    settings = dict(num_cols=40, color=True, palette=palette, fixed_frame=True)
+    full = AsciiConverter("english", "standard", **settings)
+    incremental = AsciiConverter("english", "standard", incremental=True, **settings)
+    for frame in moving_frames():
+        assert np.array_equal(incremental.convert_frame(frame), full.convert_frame(frame))
+    assert incremental.dirty_ratio < 1
+
+
+def test_incremental_frames_match_full_render():
+    full = AsciiConverter("english", "standard", num_cols=40, color=True)
+    incremental = AsciiConverter("english", "standard", num_cols=40, color=True, incremental=True)
+    for frame in moving_frames():
+        assert np.array_equal(incremental.convert_frame(frame), full.convert_frame(frame))
+
+
+def test_ansi_palette_keeps_antialiased_edges():
+    converter = AsciiConverter("english", "standard", num_cols=40, color=True, palette="ansi")
+    out_image = converter.convert_frame(gradient(120, 160))
+    entries = converter.quantize(converter.cells(gradient(120, 160))[1])
+    # Glyph edges blend each cell color over the background, giving far more colors than the cells use
+    assert len(np.unique(out_image.reshape(-1, 3), axis=0)) > 3 * len(np.unique(entries))
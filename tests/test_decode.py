@@ -0,0 +1,28 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from converter import AsciiConverter
+from decode import REDUCED_FLAGS, reduction
+
+INPUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "input.jpg")
+
+# The 70 characters of img2txt's complex mode, where a small brightness change moves a cell to another character most
+CHARACTERS = r"$@B%8&WM#*oahkbdpqwmZO0QLCJUYXzcvunxrjft/\|()1{}[]?-_+~<>i!lI;:,\"^`'. "
+
+
+@pytest.mark.parametrize("num_cols", [25, 50, 100, 120, 200])
+def test_reduced_decode_changes_few_characters(num_cols):
+    full = cv2.imread(INPUT, cv2.IMREAD_GRAYSCALE)
+    factor = reduction(full.shape[1], num_cols, largest=max(REDUCED_FLAGS))
+    assert factor > 1
+    reduced = cv2.cvtColor(cv2.imread(INPUT, REDUCED_FLAGS[factor]), cv2.COLOR_BGR2GRAY)
+
+    converter = AsciiConverter(char_list=CHARACTERS, num_cols=num_cols)
+    expected, actual = converter.reduce(full)[0], converter.reduce(reduced)[0]
+    assert actual.shape == expected.shape
+    assert np.abs(actual - expected).mean() < 0.6
+    assert np.abs(actual - expected).max() < 12
+    changed = converter.map(actual).astype(int) - converter.map(expected)
+    assert np.mean(changed != 0) < 0.13
+    assert np.mean(np.abs(changed) > 1) < 0.005
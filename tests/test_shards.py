@@ -0,0 +1,39 @@
+import os
+import shutil
+import cv2
+import numpy as np
+import pytest
+import shards
+from shards import check_join, join_shards, shard_path
+
+
+def write_video(path, frames, size=(64, 48)):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 10, size)
+    for level in frames:
+        writer.write(np.full((size[1], size[0], 3), level, np.uint8))
+    writer.release()
+
+
+def count_frames(path):
+    capture = cv2.VideoCapture(path)
+    count = 0
+    while capture.read()[0]:
+        count += 1
+    capture.release()
+    return count
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="joining mp4 segments needs ffmpeg")
+def test_join_mp4_segments(tmp_path):
+    write_video(str(tmp_path / shard_path("out.mp4", 0, 2)), [0, 40, 80])
+    write_video(str(tmp_path / shard_path("out.mp4", 1, 2)), [120, 160])
+    join_shards("out.mp4", 2, str(tmp_path))
+    assert os.listdir(tmp_path) == ["out.mp4"]
+    assert count_frames(str(tmp_path / "out.mp4")) == 5
+
+
+def test_mp4_join_without_ffmpeg_fails_first(monkeypatch):
+    monkeypatch.setattr(shards.shutil, "which", lambda name: None)
+    with pytest.raises(RuntimeError):
+        check_join("out.mp4")
+    check_join("out.asv")
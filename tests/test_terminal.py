@@ -0,0 +1,41 @@
+import io
+import cv2
+import numpy as np
+from converter import AsciiConverter
+from pipeline import frame_selection
+from terminal import play
+
+
+class FakeCapture:
+    # The part of cv2.VideoCapture play uses, over frames whose brightness is their frame number, recording which
+    # frames were decoded
+    def __init__(self, count):
+        self.count, self.position, self.decoded = count, 0, []
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        assert prop == cv2.CAP_PROP_POS_FRAMES
+        self.position = int(value)
+
+    def grab(self):
+        self.position += 1
+        return self.position <= self.count
+
+    def read(self):
+        if self.position >= self.count:
+            return False, None
+        self.decoded.append(self.position)
+        self.position += 1
+        return True, np.full((48, 64, 3), self.position - 1, np.uint8)
+
+
+def test_play_follows_the_frame_selection():
+    cap = FakeCapture(300)
+    selection = frame_selection(30, 10, 300, start=1, end=None, max_frames=5)
+    converter = AsciiConverter("english", "standard", num_cols=8, color=True)
+    shown, dropped, elapsed = play(cap, converter, 10, selection, output=io.BytesIO())
+    assert shown + dropped == 5
+    assert set(cap.decoded) <= {30, 33, 36, 39, 42} and cap.decoded == sorted(cap.decoded)
+    assert 0.4 <= elapsed < 2
@@ -0,0 +1,33 @@
+import cv2
+import numpy as np
+from converter import AsciiConverter
+from decode import read_image
+from tiles import StripReader
+
+
+def test_jpeg_strips_match_whole_image(tmp_path):
+    # Cells 20 pixels wide, which read_image decodes at a quarter of the size
+    ys, xs = np.mgrid[0:600, 0:800]
+    image = np.stack([xs * 255 // 800, ys * 255 // 600, (xs + ys) % 256], axis=2).astype(np.uint8)
+    path = str(tmp_path / "input.jpg")
+    cv2.imwrite(path, image)
+
+    converter = AsciiConverter("english", "standard", num_cols=40, color=True)
+    whole = converter.convert_frame(read_image(path, 40))
+    output = str(tmp_path / "strips.png")
+    converter.convert_tiled(StripReader(path, 40), output, strip_rows=4)
+    assert np.array_equal(cv2.imread(output), whole)
+
+
+def test_equalized_shape_strips_match_whole_image(tmp_path):
+    # Uncompressed PPM, read a strip at a time, with a brighter top half so strips differ in their histograms
+    ys, xs = np.mgrid[0:480, 0:640]
+    image = ((xs * 7 + ys * 3) % 256 // np.where(ys < 240, 1, 4)).astype(np.uint8)
+    path = str(tmp_path / "input.ppm")
+    cv2.imwrite(path, cv2.merge([image] * 3))
+
+    converter = AsciiConverter("english", "standard", num_cols=60, match="shape", equalize=True)
+    whole = converter.convert_frame(cv2.imread(path, cv2.IMREAD_GRAYSCALE))
+    output = str(tmp_path / "strips.png")
+    converter.convert_tiled(StripReader(path, 60), output, strip_rows=3)
+    assert np.array_equal(cv2.imread(output, cv2.IMREAD_GRAYSCALE), whole)
@@ -0,0 +1,16 @@
+from timing import progress_due, progress_unreported
+
+
+def test_last_frame_of_unknown_total_is_reported_after_the_loop():
+    state = {}
+    reported = [frame_idx for frame_idx in range(1, 26) if progress_due(state, 100, frame_idx, None)]
+    assert reported == [1]
+    assert progress_unreported(state, 25)
+
+
+def test_known_total_reports_its_last_frame_in_the_loop():
+    state = {}
+    reported = [frame_idx for frame_idx in range(1, 26) if progress_due(state, 100, frame_idx, 25)]
+    assert reported == [1, 25]
+    assert not progress_unreported(state, 25)
+    assert not progress_unreported({}, 0)
@@ -0,0 +1,50 @@
+from argparse import ArgumentTypeError
+import pytest
+from utils import palette_option
+
+
+def test_palette_option():
+    assert palette_option("ansi") == "ansi"
+    assert palette_option("16") == 16
+    for text in ("0", "1", "-4"):
+        with pytest.raises(ArgumentTypeError):
+            palette_option(text)
+    with pytest.raises(ValueError):
+        palette_option("many")
+
+
+def english_font():
+    from utils import LANGUAGES, load_font
+    return load_font(LANGUAGES["english"]["font"], LANGUAGES["english"]["size"])
+
+
+def rank_and_read(cache_dir, repeat=5):
+    # Rank the English characters again and again while other processes do the same
+    import utils
+    import alphabets
+    utils.CACHE_DIR = cache_dir
+    characters = alphabets.ENGLISH["standard"]
+    return [utils.cached_arrange_characters(characters, english_font(), "english", "standard", rebuild=step % 2 == 0)
+            for step in range(repeat)]
+
+
+def test_corrupt_cache_entry_is_ranked_again(tmp_path, monkeypatch):
+    import utils
+    import alphabets
+    monkeypatch.setattr(utils, "CACHE_DIR", str(tmp_path))
+    characters = alphabets.ENGLISH["standard"]
+    expected = utils.arrange_characters(characters, english_font(), "english")
+    assert utils.cached_arrange_characters(characters, english_font(), "english", "standard") == expected
+    (entry,) = tmp_path.iterdir()
+    entry.write_text('{"characters": "ab', encoding="utf-8")
+    assert utils.cached_arrange_characters(characters, english_font(), "english", "standard") == expected
+    assert utils.cached_arrange_characters(characters, english_font(), "english", "standard") == expected
+    assert [path.name for path in tmp_path.iterdir()] == [entry.name]
+
+
+def test_concurrent_processes_share_the_cache(tmp_path):
+    from multiprocessing import Pool
+    with Pool(4) as pool:
+        results = pool.map(rank_and_read, [str(tmp_path)] * 8)
+    assert len({result for results_of_one in results for result in results_of_one}) == 1
+    assert not [path for path in tmp_path.iterdir() if path.suffix == ".tmp"]
@@ -0,0 +1,193 @@
+import os
+import struct
+import zlib
+import cv2
+import numpy as np
+from PIL import Image
+from decode import read_image
+
+# Uncompressed pixel layouts that can be read from the file row by row: bytes per pixel and the channels in BGR order
+RAW_LAYOUTS = {
+    "L": (1, [0, 0, 0]),
+    "RGB": (3, [2, 1, 0]),
+    "BGR": (3, [0, 1, 2]),
+    "RGBX": (4, [2, 1, 0]),
+    "RGBA": (4, [2, 1, 0]),
+    "BGRX": (4, [0, 1, 2]),
+    "BGRA": (4, [0, 1, 2]),
+}
+
+
+class StripReader:
+    # Reads horizontal strips of an image as BGR arrays. Uncompressed layouts (PPM, BMP, uncompressed TIFF) are read
+    # from the file a strip at a time; other formats can only be decoded whole, JPEGs at the reduction read_image
+    # would use for num_cols columns.
+
+    def __init__(self, path, num_cols=None):
+        self.bands = None
+        with Image.open(path) as image:
+            self.width, self.height = image.size
+            tiles = image.tile
+
+        # Every tile must be a full-width band of raw rows in a known layout. Tiles are plain tuples before Pillow 11,
+        # so they are unpacked by position.
+        bands = []
+        for tile in tiles:
+            codec, extents, offset, args = tile[:4]
+            args = (args,) if isinstance(args, str) else tuple(args)
+            x0, y0, x1, y1 = extents
+            if codec != "raw" or args[0] not in RAW_LAYOUTS or (x0, x1) != (0, self.width):
+                break
+            pixel_bytes, order = RAW_LAYOUTS[args[0]]
+            stride = args[1] if len(args) > 1 and args[1] else self.width * pixel_bytes
+            bottom_up = len(args) > 2 and args[2] < 0
+            bands.append((y0, y1, offset, stride, bottom_up, pixel_bytes, order))
+        else:
+            self.bands = bands
+            self.path = path
+
+        if self.bands is None:
+            print("Only uncompressed PPM, BMP and TIFF input is read in strips. Decoding the whole image.")
+            if num_cols is None:
+                self.image = cv2.imread(path, cv2.IMREAD_COLOR)
+                if self.image is None:
+                    raise ValueError(f"Cannot read {path}")
+            else:
+                self.image = read_image(path, num_cols)
+            self.height, self.width = self.image.shape[:2]
+
+    @property
+    def streamed(self):
+        return self.bands is not None
+
+    def read(self, top, bottom):
+        # Rows top to bottom of the image, the same pixels read_image would give for them
+        if self.bands is None:
+            return self.image[top:bottom]
+        parts = []
+        for y0, y1, offset, stride, bottom_up, pixel_bytes, order in self.bands:
+            first, last = max(top, y0) - y0, min(bottom, y1) - y0
+            if first >= last:
+                continue
+
+            # Read just the bytes of these rows; bottom-up files store the last row first
+            start = (y1 - y0 - last) if bottom_up else first
+            rows = np.fromfile(self.path, np.uint8, (last - first) * stride, offset=offset + start * stride)
+            rows = rows.reshape(last - first, stride)[:, :self.width * pixel_bytes]
+            if bottom_up:
+                rows = rows[::-1]
+            parts.append(rows.reshape(last - first, self.width, pixel_bytes)[..., order])
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+class PngWriter:
+    # Writes a PNG from BGR or grayscale rows as they come, compressing them into IDAT chunks on the way
+
+    def __init__(self, path, width, height, channels):
+        self.file = open(path, "wb")
+        self.channels = channels
+        self.compressor = zlib.compressobj(6)
+        self.pending = b""
+        color_type = 2 if channels == 3 else 0
+        self.file.write(b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type,
+                                                                            0, 0, 0)))
+
+    def write(self, rows):
+        # Every row starts with filter type 0, colors are stored as RGB
+        if self.channels == 3:
+            rows = rows[..., ::-1]
+        rows = rows.reshape(rows.shape[0], -1)
+        data = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+        data[:, 0] = 0
+        data[:, 1:] = rows
+        self.pending += self.compressor.compress(data.tobytes())
+        if len(self.pending) >= 1 << 20:
+            self.file.write(png_chunk(b"IDAT", self.pending))
+            self.pending = b""
+
+    def close(self):
+        self.file.write(png_chunk(b"IDAT", self.pending + self.compressor.flush()) + png_chunk(b"IEND", b""))
+        self.file.close()
+
+
+class TiffWriter:
+    # Writes a deflate-compressed TIFF from BGR or grayscale rows as they come, one strip per rows_per_strip rows;
+    # strip offsets and the directory go at the end, once all strips are known
+
+    def __init__(self, path, width, height, channels, rows_per_strip=64):
+        self.file = open(path, "wb")
+        self.width, self.height, self.channels = width, height, channels
+        self.rows_per_strip = rows_per_strip
+        self.pending = []
+        self.strips = []
+        self.file.write(b"II*\x00" + struct.pack("<I", 0))
+
+    def write(self, rows):
+        # Keep whole strips only, the last one may be shorter
+        if self.channels == 3:
+            rows = rows[..., ::-1]
+        self.pending.append(np.ascontiguousarray(rows))
+        pending_rows = sum(part.shape[0] for part in self.pending)
+        if pending_rows >= self.rows_per_strip:
+            rows = np.concatenate(self.pending)
+            whole = pending_rows - pending_rows % self.rows_per_strip
+            for start in range(0, whole, self.rows_per_strip):
+                self.write_strip(rows[start:start + self.rows_per_strip])
+            self.pending = [rows[whole:]] if whole < pending_rows else []
+
+    def write_strip(self, rows):
+        data = zlib.compress(rows.tobytes(), 6)
+        self.strips.append((self.file.tell(), len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self.pending:
+            self.write_strip(np.concatenate(self.pending))
+
+        # Arrays referenced by the directory: strip offsets, strip sizes and bits per sample
+        offsets_at = self.file.tell()
+        self.file.write(np.array([offset for offset, _ in self.strips], "<u4").tobytes())
+        sizes_at = self.file.tell()
+        self.file.write(np.array([size for _, size in self.strips], "<u4").tobytes())
+        bits_at = self.file.tell()
+        self.file.write(struct.pack("<HHH", 8, 8, 8))
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+
+        # Directory entries as (tag, type, count, value), sorted by tag; type 3 is SHORT, 4 is LONG
+        many = len(self.strips) > 1
+        entries = [
+            (256, 4, 1, self.width),
+            (257, 4, 1, self.height),
+            (258, 3, self.channels, bits_at if self.channels == 3 else 8),
+            (259, 3, 1, 8),
+            (262, 3, 1, 2 if self.channels == 3 else 1),
+            (273, 4, len(self.strips), offsets_at if many else self.strips[0][0]),
+            (277, 3, 1, self.channels),
+            (278, 4, 1, self.rows_per_strip),
+            (279, 4, len(self.strips), sizes_at if many else self.strips[0][1]),
+            (284, 3, 1, 1),
+        ]
+        directory_at = self.file.tell()
+        self.file.write(struct.pack("<H", len(entries)))
+        for tag, kind, count, value in entries:
+            packed = struct.pack("<HH", value, 0) if kind == 3 and count == 1 else struct.pack("<I", value)
+            self.file.write(struct.pack("<HHI", tag, kind, count) + packed)
+        self.file.write(struct.pack("<I", 0))
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", directory_at))
+        self.file.close()
+
+
+def open_image_writer(path, width, height, channels):
+    # Only formats whose rows can be written as they come are supported
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".png":
+        return PngWriter(path, width, height, channels)
+    if extension in (".tif", ".tiff"):
+        return TiffWriter(path, width, height, channels)
+    raise ValueError(f"Strip-by-strip output needs a .png or .tiff file, not {extension}")
@@ -0,0 +1,101 @@
+import json
+import time
+import numpy as np
+
+# Stages of the video loop in the order a frame passes through them
+STAGES = ("decode", "convert", "reduce", "map", "render", "crop", "overlay", "encode")
+
+
+def clock(times):
+    # Start timing when instrumentation is on; costs nothing otherwise
+    return time.perf_counter() if times is not None else None
+
+
+def lap(times, stage, start):
+    # Add the time since start to a stage and return the new start
+    if times is None:
+        return None
+    now = time.perf_counter()
+    times[stage] = times.get(stage, 0.0) + now - start
+    return now
+
+
+def parse_frame_range(text):
+    # "START:END" frames, END excluded; a missing END means until the last frame
+    if not text:
+        return None
+    start, _, end = text.partition(":")
+    return int(start or 0), int(end) if end else None
+
+
+def open_trace(path):
+    # Per-frame stage times go to a JSON Lines file when a path is given
+    return open(path, "w", encoding="utf-8") if path else None
+
+
+def write_trace(trace, frame_idx, times):
+    trace.write(json.dumps(dict(frame=frame_idx, total=sum(times.values()), **times)) + "\n")
+
+
+def summarize(frame_times, wall):
+    # Percentiles of every stage in milliseconds, and its share of the total time spent in stages
+    lines = [f"{'stage':<10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'share':>9}"]
+    totals = {stage: np.array([times.get(stage, 0.0) for times in frame_times]) * 1000 for stage in STAGES}
+    stage_sum = sum(values.sum() for values in totals.values()) or 1
+    for stage in STAGES:
+        values = totals[stage]
+        if not values.any():
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        lines.append(f"{stage:<10}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}{values.max():>10.2f}"
+                     f"{values.sum() / stage_sum:>9.1%}")
+    lines.append(f"{len(frame_times)} frames in {wall:.2f}s, {len(frame_times) / wall:.2f} FPS")
+    return "\n".join(lines)
+
+
+def progress_due(state, interval, frame_idx, count):
+    # Report progress at most once per interval seconds, and always for the last frame when the total is known
+    now = time.perf_counter()
+    if frame_idx == count or now - state.get("last", -interval) >= interval:
+        state["last"], state["frame"] = now, frame_idx
+        return True
+    return False
+
+
+def progress_unreported(state, frame_idx):
+    # Whether the loop ended after a frame no progress message reported, as it does when the total is unknown or the
+    # input ends early
+    return frame_idx > 0 and state.get("frame") != frame_idx
+
+
+def frame_progress(frame_idx, count):
+    # Frame number for progress messages, out of the total when it is known
+    return f"{frame_idx}" if count is None else f"{frame_idx}/{count}"
+
+
+def profile_step(state, frame_idx, frame_range):
+    # Switch cProfile on when the loop reaches the first frame of the range and off after the last one
+    if frame_range is None:
+        return
+    start, end = frame_range
+    if frame_idx == start and "profiler" not in state:
+        import cProfile
+        state["profiler"] = cProfile.Profile()
+        state["profiler"].enable()
+    elif frame_idx == end and state.get("profiler"):
+        state["profiler"].disable()
+
+
+def profile_report(state, path=None, limit=20):
+    # Stop the profiler if the video ended inside the range, save the raw stats and return the top functions
+    profiler = state.get("profiler")
+    if profiler is None:
+        return None
+    profiler.disable()
+    if path:
+        profiler.dump_stats(path)
+    import io
+    import pstats
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(limit)
+    return stream.getvalue()
@@ -1,8 +1,47 @@
+import hashlib
+from argparse import ArgumentTypeError
+import json
+import os
+import tempfile
 import numpy as np
-from PIL import Image, ImageFont, ImageDraw, ImageOps
+
+CACHE_DIR = os.path.join("cache", "charsets")
+
+# Character set in alphabets.py, font file and size, the character whose box sizes a cell, and the cell height as a
+# multiple of the cell width, for every language
+LANGUAGES = {
+    "general": {"charset": "GENERAL", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+                "scale": 2},
+    "english": {"charset": "ENGLISH", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+                "scale": 2},
+    "german": {"charset": "GERMAN", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+               "scale": 2},
+    "french": {"charset": "FRENCH", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+               "scale": 2},
+    "italian": {"charset": "ITALIAN", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+                "scale": 2},
+    "polish": {"charset": "POLISH", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+               "scale": 2},
+    "portuguese": {"charset": "PORTUGUESE", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+                   "scale": 2},
+    "spanish": {"charset": "SPANISH", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "A",
+                "scale": 2},
+    "russian": {"charset": "RUSSIAN", "font": "fonts/DejaVuSansMono-Bold.ttf", "size": 20, "sample_char": "Ш",
+                "scale": 2},
+    "chinese": {"charset": "CHINESE", "font": "fonts/simsun.ttc", "size": 10, "sample_char": "制", "scale": 1},
+    "korean": {"charset": "KOREAN", "font": "fonts/arial-unicode.ttf", "size": 10, "sample_char": "ㅊ", "scale": 1},
+    "japanese": {"charset": "JAPANESE", "font": "fonts/arial-unicode.ttf", "size": 10, "sample_char": "お",
+                 "scale": 1},
+}
+
+# In-process memos of get_data results, keyed by (language, mode), and of open fonts, keyed by (path, size)
+_data_memo = {}
+_font_memo = {}
 
 
 def arrange_characters(char_list, font, lang):
+    from PIL import Image, ImageDraw, ImageOps
+
     # Determine character dimensions based on the language
     if lang == "chinese":
         char_w, char_h = font.getbbox("制")[2], font.getbbox("制")[3]
@@ -55,71 +94,62 @@ def arrange_characters(char_list, font, lang):
     return result
 
 
-def get_data(language, mode):
-    # Load character sets and fonts based on the specified language
-    if language == "general":
-        from alphabets import GENERAL as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "english":
-        from alphabets import ENGLISH as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "german":
-        from alphabets import GERMAN as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "french":
-        from alphabets import FRENCH as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "italian":
-        from alphabets import ITALIAN as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "polish":
-        from alphabets import POLISH as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "portuguese":
-        from alphabets import PORTUGUESE as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "spanish":
-        from alphabets import SPANISH as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "A"
-        scale = 2
-    elif language == "russian":
-        from alphabets import RUSSIAN as characters
-        font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=20)
-        sample_char = "Ш"
-        scale = 2
-    elif language == "chinese":
-        from alphabets import CHINESE as characters
-        font = ImageFont.truetype("fonts/simsun.ttc", size=10)
-        sample_char = "制"
-        scale = 1
-    elif language == "korean":
-        from alphabets import KOREAN as characters
-        font = ImageFont.truetype("fonts/arial-unicode.ttf", size=10)
-        sample_char = "ㅊ"
-        scale = 1
-    elif language == "japanese":
-        from alphabets import JAPANESE as characters
-        font = ImageFont.truetype("fonts/arial-unicode.ttf", size=10)
-        sample_char = "お"
-        scale = 1
-    else:
+def font_hash(font_path):
+    # Hash the font file so a changed font invalidates its cached rankings
+    with open(font_path, "rb") as font_file:
+        return hashlib.sha1(font_file.read()).hexdigest()
+
+
+def cached_arrange_characters(char_list, font, lang, mode, rebuild=False):
+    # Look up the ranked character string on disk, keyed by language, mode, font file and font size
+    key = "{}_{}_{}_{}".format(lang, mode, font_hash(font.path)[:16], font.size)
+    cache_path = os.path.join(CACHE_DIR, key + ".json")
+    if not rebuild and os.path.exists(cache_path):
+        # An entry that cannot be read or parsed is ranked again and replaced
+        try:
+            with open(cache_path, encoding="utf-8") as cache_file:
+                return json.load(cache_file)["characters"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    # Rank the characters and store them with their glyph metrics, written to a temporary file first and moved into
+    # place, so processes ranking at the same time never read a half-written entry
+    result = arrange_characters(char_list, font, lang)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=CACHE_DIR)
+    try:
+        with open(descriptor, "w", encoding="utf-8") as cache_file:
+            json.dump({"characters": result, "bboxes": {char: font.getbbox(char) for char in result}}, cache_file,
+                      ensure_ascii=False)
+        os.replace(temporary_path, cache_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    return result
+
+
+def load_font(path, size):
+    # Open a font file once per size; Pillow is only imported when a font is first needed
+    if (path, size) not in _font_memo:
+        from PIL import ImageFont
+        _font_memo[path, size] = ImageFont.truetype(path, size=size)
+    return _font_memo[path, size]
+
+
+def get_data(language, mode, rebuild_cache=False):
+    # Reuse data already loaded in this process
+    if not rebuild_cache and (language, mode) in _data_memo:
+        return _data_memo[language, mode]
+
+    # Look up the character sets and font of the language; only its font is opened
+    if language not in LANGUAGES:
         print("Invalid language")
         return None, None, None, None
+    spec = LANGUAGES[language]
+    import alphabets
+    characters = getattr(alphabets, spec["charset"])
+    font = load_font(spec["font"], spec["size"])
+    sample_char, scale = spec["sample_char"], spec["scale"]
 
     # Load character list based on mode
     try:
@@ -133,6 +163,24 @@ def get_data(language, mode):
 
     # Arrange characters if not in general mode
     if language != "general":
-        char_list = arrange_characters(char_list, font, language)
+        char_list = cached_arrange_characters(char_list, font, language, mode, rebuild_cache)
+
+    _data_memo[language, mode] = char_list, font, sample_char, scale
+    return _data_memo[language, mode]
+
+
+def sized_output(path, num_cols, sizes):
+    # Output name of one of several --num_cols values, suffixed with its width; a single width keeps the name
+    if len(sizes) == 1:
+        return path
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_{num_cols}{extension}"
+
 
-    return char_list, font, sample_char, scale
\ No newline at end of file
+def palette_option(text):
+    # --palette value: a number of colors, at least two, or ansi for the fixed palette
+    if text == "ansi":
+        return text
+    if int(text) < 2:
+        raise ArgumentTypeError(f"a palette needs at least 2 colors, not {text}")
+    return int(text)
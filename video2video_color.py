@@ -1,25 +1,141 @@
 import argparse
+import contextlib
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw, ImageOps, ImageFont
+from PIL import ImageFont
 import os
+import time
+import sys
+from converter import AsciiConverter, shared_frames
+from shards import shard_path, convert_shards, check_join, join_shards
+import gridvideo
+from utils import sized_output, palette_option
+from decode import frame_reductions, reduce_frame, reduce_frames
+from sources import PIPE, RAW_FORMATS, parse_size, open_source, open_writer
+from pipeline import frame_selection, shard_selection, read_frames, prefetch, sample_frames, convert_frames
+from timing import (clock, lap, open_trace, write_trace, summarize, progress_due, progress_unreported,
+                    frame_progress, parse_frame_range, profile_step, profile_report)
+from terminal import play
+from palette import fit_palette
+
 
 def parse_arguments():
     # Set up argument parser for command line inputs
     parser = argparse.ArgumentParser("Video to ASCII")
-    parser.add_argument("--input", type=str, default="data/input.mp4", help="Path to input video")
-    parser.add_argument("--output", type=str, default="vid_Color_output.mp4", help="Path to output video")
+    parser.add_argument("--input", type=str, default="data/input.mp4",
+                        help="Input video, image sequence as a directory, glob or %%05d pattern, animated GIF, or - "
+                             "for raw frames on standard input")
+    parser.add_argument("--output", type=str, default="vid_Color_output.mp4",
+                        help="Path to output video, or - for raw bgr24 frames on standard output")
+    parser.add_argument("--input_size", type=parse_size, default=None,
+                        help="WIDTHxHEIGHT of raw frames on standard input")
+    parser.add_argument("--pixel_format", type=str, default="bgr24", choices=list(RAW_FORMATS),
+                        help="Pixel format of raw frames on standard input")
+    parser.add_argument("--input_fps", type=float, default=0,
+                        help="Frame rate of raw frames and image sequences, 30 by default, or to override a GIF's")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Frames decoded ahead on a background thread while others convert, 0 to decode in line")
     parser.add_argument("--mode", type=str, default="complex", choices=["simple", "complex"],
                         help="10 or 70 different characters")
     parser.add_argument("--background", type=str, default="black", choices=["black", "white"],
                         help="Background color for output video")
-    parser.add_argument("--num_cols", type=int, default=100, help="Number of characters for output's width")
+    parser.add_argument("--num_cols", type=int, nargs="+", default=[100],
+                        help="Number of characters for output's width; several widths are written from one decode, "
+                             "each output named with its width")
+    parser.add_argument("--gamma", type=float, default=1.0,
+                        help="Gamma applied to cell brightness before choosing characters, above 1 darkens mid tones")
+    parser.add_argument("--equalize", action="store_true",
+                        help="Spread cell brightness over the whole character set with histogram "
+                             "equalization per frame")
+    parser.add_argument("--match", type=str, default="luminance", choices=["luminance", "shape"],
+                        help="Choose characters by cell brightness, or by how closely their glyph matches the cell")
+    parser.add_argument("--palette", type=palette_option, default=None,
+                        help="Quantize cell colors to this many colors fitted to frames sampled over the video, or "
+                             "to the xterm 256-color palette with ansi")
     parser.add_argument("--scale", type=int, default=1, help="Upsize output")
-    parser.add_argument("--fps", type=int, default=0, help="Frames per second")
+    parser.add_argument("--fps", type=float, default=0,
+                        help="Output frames per second; source frames are skipped or repeated to keep the speed")
+    parser.add_argument("--start", type=float, default=0, help="Time in seconds to start converting at")
+    parser.add_argument("--end", type=float, default=None, help="Time in seconds to stop converting at")
+    parser.add_argument("--max_frames", "--max-frames", type=int, default=0,
+                        help="Largest number of output frames, 0 for no limit")
     parser.add_argument("--overlay_ratio", type=float, default=0.2, help="Overlay width ratio")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Re-render only cells whose character or color changed since the previous frame")
+    parser.add_argument("--color_tolerance", type=int, default=0,
+                        help="Largest per-channel color change that does not re-render a cell in incremental mode")
+    parser.add_argument("--terminal", action="store_true", help="Play the video as ANSI art in the terminal")
+    parser.add_argument("--color_mode", type=str, default="truecolor", choices=["truecolor", "256"],
+                        help="Terminal colors used by --terminal")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Split the output frames into this many time segments, converted by separate processes "
+                             "and joined without re-encoding")
+    parser.add_argument("--shard", type=int, default=None,
+                        help="Convert only this segment of --shards, counting from 0, for example on another machine "
+                             "sharing the results directory")
+    parser.add_argument("--join", action="store_true",
+                        help="Join the segments of --shards converted separately with --shard")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes converting frames in parallel")
+    parser.add_argument("--keyframe_interval", type=int, default=60,
+                        help="Frames between keyframes when the output is an .asv grid video")
+    parser.add_argument("--color_bits", type=int, default=5, choices=range(1, 9),
+                        help="Bits per color channel stored in an .asv grid video")
+    parser.add_argument("--progress_interval", type=float, default=1.0,
+                        help="Seconds between progress messages, 0 to report every frame")
+    parser.add_argument("--timing", action="store_true",
+                        help="Time every stage of the video loop and print percentiles at the end")
+    parser.add_argument("--trace", type=str, default=None, help="JSON Lines file of per-frame stage times")
+    parser.add_argument("--profile_frames", type=str, default=None,
+                        help="Run cProfile over the frames START:END, END excluded")
+    parser.add_argument("--profile_output", type=str, default=None, help="File to save the cProfile stats to")
     return parser.parse_args()
 
 
+def convert_frame(frame, settings):
+    # Stage times of this frame when instrumentation is on
+    times = {} if settings["timing"] else None
+
+    # Every width is converted from the same frame and, for several widths, its summed-area table, unless the widths
+    # need different reductions of the frame
+    frames = reduce_frames(frame, settings["reductions"])
+    shared = shared_frames(settings["converters"], frames, times)
+    out_images = []
+    for converter, source, (image, table) in zip(settings["converters"], frames, shared):
+        # Convert the frame, keeping it in BGR for video writing; it is the converter's frame buffer, reused every
+        # frame
+        out_image = converter.convert_frame(image, times, table)
+        start = clock(times)
+
+        # Overlay if specified, resized straight into its corner of the frame
+        if settings["overlay_ratio"]:
+            overlay_width = int(out_image.shape[1] * settings["overlay_ratio"])
+            overlay_height = int(out_image.shape[0] * settings["overlay_ratio"])
+            cv2.resize(source, (overlay_width, overlay_height), dst=out_image[-overlay_height:, -overlay_width:])
+            lap(times, "overlay", start)
+        out_images.append(out_image)
+
+    return out_images, times
+
+
+def record(cap, converters, reductions, outputs, options, fps, selection):
+    # Reduce every frame to its grids and append them to the grid videos, without rendering anything
+    progress_state, frame_idx = {}, 0
+    writers = [gridvideo.GridVideoWriter("results/" + output, converter, fps, options.color_bits,
+                                         options.keyframe_interval) for converter, output in zip(converters, outputs)]
+    for frame_idx, frame in enumerate(prefetch(read_frames(cap, **selection), options.prefetch), 1):
+        frames = shared_frames(converters, reduce_frames(frame, reductions))
+        for converter, writer, (image, table) in zip(converters, writers, frames):
+            writer.write(*converter.cells(image, table=table))
+        if progress_due(progress_state, options.progress_interval, frame_idx, selection["count"]):
+            print(f"Recorded frame {frame_progress(frame_idx, selection['count'])}")
+    if progress_unreported(progress_state, frame_idx):
+        print(f"Recorded frame {frame_progress(frame_idx, selection['count'])}")
+    for writer in writers:
+        writer.close()
+    cap.release()
+    print("Video conversion completed successfully!")
+
+
 def execute_conversion(options):
     # Create results directory if it doesn't exist
     os.makedirs("results", exist_ok=True)
@@ -30,115 +146,176 @@ def execute_conversion(options):
     else:
         char_list = r"$@B%8&WM#*oahkbdpqwmZO0QLCJUYXzcvunxrjft/\\|()1{}[]?-_+~<>i!lI;:,\"^`'. "
 
-    # Determine background color based on user input
-    bg_color = (255, 255, 255) if options.background == "white" else (0, 0, 0)
-
     # Load font
     font = ImageFont.truetype("fonts/DejaVuSansMono-Bold.ttf", size=int(10 * options.scale))
 
-    # Open video capture
-    cap = cv2.VideoCapture(options.input)
+    # Open the frame source: a video file, an image sequence, an animated GIF or raw frames on standard input
+    source = dict(size=options.input_size, pixel_format=options.pixel_format, fps=options.input_fps)
+    cap = open_source(options.input, **source)
 
     # Get input video properties
     input_fps = cap.get(cv2.CAP_PROP_FPS)
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = input_fps if options.fps == 0 else options.fps
 
-    # Calculate frame duration
-    frame_duration = 1.0 / input_fps
-
-    print(f"Input FPS: {input_fps}, Total frames: {frame_count}, Output FPS: {fps}")
-
-    num_chars = len(char_list)
-    num_cols = options.num_cols
-
-    out = None
+    # Pick the source frames at the output rate, within the requested time range
+    selection = frame_selection(input_fps, fps, frame_count, options.start, options.end, options.max_frames)
+
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    # Frames are shrunk as soon as they are decoded, as far as the cells allow, when every width allows the same
+    # reduction; otherwise each width shrinks its own copy, so it gets the frames a conversion of it alone would
+    selection["reduction"], reductions = frame_reductions(width, options.num_cols)
+    width, height = width // selection["reduction"], height // selection["reduction"]
+
+    if not options.terminal:
+        print(f"Input FPS: {input_fps}, Total frames: {frame_count}, Output FPS: {fps}, "
+              f"Output frames: {'unknown' if selection['count'] is None else selection['count']}")
+
+    # Convert with a fixed character list and font, one converter per width, rasterizing every character once
+    # before workers start
+    converters = []
+    for num_cols, factor in zip(options.num_cols, reductions):
+        converter = AsciiConverter(char_list=char_list, font=font, num_cols=num_cols, color=True,
+                                   background=options.background, incremental=options.incremental,
+                                   color_tolerance=options.color_tolerance,
+                                   gamma=options.gamma, equalize=options.equalize, match=options.match,
+                                   palette=options.palette, fixed_frame=True)
+        converter.glyphs()
+        converter.layout((height // factor, width // factor))
+        converters.append(converter)
+    outputs = [sized_output(options.output, num_cols, options.num_cols) for num_cols in options.num_cols]
+    if options.output == PIPE and len(outputs) > 1:
+        raise ValueError("Standard output carries the frames of a single --num_cols")
+
+    # One palette for the whole video and every width, fitted to the cell colors of frames sampled over it
+    if options.palette and converters[0].palette is None:
+        frames = sample_frames(options.input, source, **selection)
+        samples = [converters[0].reduce(reduce_frame(frame, reductions[0]))[1] for frame in frames]
+        if samples:
+            palette = fit_palette(np.concatenate(samples), options.palette)
+            for converter in converters:
+                converter.set_palette(palette)
+
+    # A segment converts only its own output frames, into its own part files
+    if options.shard is not None:
+        selection = shard_selection(selection, options.shard, options.shards)
+        outputs = [shard_path(output, options.shard, options.shards) for output in outputs]
+
+    # Everything a worker needs to convert a frame on its own
+    settings = {
+        "converters": converters,
+        "reductions": reductions,
+        "overlay_ratio": options.overlay_ratio,
+        "timing": options.timing or bool(options.trace),
+    }
+
+    # Stream to the terminal instead of encoding a video, at the first width
+    if options.terminal:
+        shown, dropped, elapsed = play(cap, converters[0], fps, selection, reductions[0], options.color_mode,
+                                       options.color_tolerance)
+        cap.release()
+        print(f"Played {shown} frames at {shown / elapsed:.1f} FPS, dropped {dropped} frames", file=sys.stderr)
+        return
+
+    # Store only the character and color grids in a grid video instead of rendering the frames
+    if options.output.endswith(gridvideo.EXTENSION):
+        record(cap, converters, reductions, outputs, options, fps, selection)
+        return
+
+    # Incremental rendering depends on the previous frame, so frames must be converted in order
+    if options.incremental and options.workers > 1:
+        print("Incremental rendering needs frames in order. Using a single worker.")
+        options.workers = 1
+
+    # cProfile only sees this process, so the profiled frames must be converted here
+    profile_range = parse_frame_range(options.profile_frames)
+    if profile_range and options.workers > 1:
+        print("Profiling needs frames converted in this process. Using a single worker.")
+        options.workers = 1
+
+    outs = []
     frame_idx = 0
-
-    while cap.isOpened():
-        flag, frame = cap.read()
-
-        if not flag:
-            break
-
-        # Process the current frame (keep it in color)
-        image = frame
-
-        height, width, _ = image.shape
-        cell_width = width / num_cols
-        cell_height = 2 * cell_width
-        num_rows = int(height / cell_height)
-
-        # Adjust cell dimensions if they exceed image dimensions
-        if num_cols > width or num_rows > height:
-            print("Too many columns or rows. Using default settings.")
-            cell_width = 6
-            cell_height = 12
-            num_cols = int(width / cell_width)
-            num_rows = int(height / cell_height)
-
-        # Get character dimensions for drawing
-        char_bbox = font.getbbox("A")
-        char_width, char_height = char_bbox[2], char_bbox[3]
-
-        # Create a new image for the output
-        out_width = char_width * num_cols
-        out_height = 2 * char_height * num_rows
-        out_image = Image.new("RGB", (out_width, out_height), bg_color)
-
-        draw = ImageDraw.Draw(out_image)
-
-        # Loop through each cell to calculate average color and draw characters
-        for i in range(num_rows):
-            for j in range(num_cols):
-                partial_image = image[int(i * cell_height):min(int((i + 1) * cell_height), height),
-                                      int(j * cell_width):min(int((j + 1) * cell_width), width)]
-
-                # Calculate the average color for the region
-                avg_color = tuple(np.clip(np.mean(partial_image, axis=(0, 1)).astype(int), 0, 255))
-
-                # Select the character based on grayscale value
-                char = char_list[min(int(np.mean(partial_image) * num_chars / 255), num_chars - 1)]
-
-                # Draw the character on the output image
-                draw.text((j * char_width, i * char_height), char, fill=avg_color, font=font)
-
-        # Crop the output image based on background color
-        cropped_area = out_image.getbbox() if options.background == "black" else ImageOps.invert(out_image).getbbox()
-        out_image = out_image.crop(cropped_area)
-
-        # Convert to BGR for video writing
-        out_image = cv2.cvtColor(np.array(out_image), cv2.COLOR_RGB2BGR)
-
-        # Initialize video writer if not already done
-        if out is None:
-            out = cv2.VideoWriter("results/" + options.output, cv2.VideoWriter_fourcc(*"mp4v"), fps,
-                                  (out_image.shape[1], out_image.shape[0]))
-
-        # Overlay if specified
-        if options.overlay_ratio:
-            overlay_width = int(out_image.shape[1] * options.overlay_ratio)
-            overlay_height = int(out_image.shape[0] * options.overlay_ratio)
-            overlay = cv2.resize(frame, (overlay_width, overlay_height))
-            out_image[-overlay_height:, -overlay_width:, :] = overlay
-
-        # Write the frame to the output video
-        out.write(out_image)
-
-        # Increment time and frame index
-        time_elapsed += frame_duration
+    dirty_ratios = []
+
+    # Instrumentation state: decode times, per-frame stage times, trace file, profiler and progress pacing
+    decode_times = [] if settings["timing"] else None
+    frame_times = []
+    trace = open_trace(options.trace)
+    profile_state, progress_state = {}, {}
+    loop_start = time.perf_counter()
+    profile_step(profile_state, frame_idx, profile_range)
+
+    frames = prefetch(read_frames(cap, decode_times, **selection), options.prefetch)
+    for out_images, times in convert_frames(frames, convert_frame, settings, options.workers):
+        # Initialize video writers if not already done
+        if not outs:
+            outs = [open_writer(output, fps, (out_image.shape[1], out_image.shape[0]))
+                    for output, out_image in zip(outputs, out_images)]
+
+        # Write the frames to the output videos
+        start = clock(times)
+        for out, out_image in zip(outs, out_images):
+            out.write(out_image)
+
+        # Collect the stage times of the frame, decoding included
+        if times is not None:
+            lap(times, "encode", start)
+            times["decode"] = decode_times[frame_idx]
+            frame_times.append(times)
+            if trace:
+                write_trace(trace, frame_idx, times)
+
+        # Increment frame index
         frame_idx += 1
-
-        print(f"Processed frame {frame_idx}/{frame_count}")
+        profile_step(profile_state, frame_idx, profile_range)
+
+        if options.incremental:
+            dirty_ratios.append(converters[0].dirty_ratio)
+        if progress_due(progress_state, options.progress_interval, frame_idx, selection["count"]):
+            progress = frame_progress(frame_idx, selection["count"])
+            if options.incremental:
+                print(f"Processed frame {progress}, dirty cells: {dirty_ratios[-1]:.1%}")
+            else:
+                print(f"Processed frame {progress}")
+    if progress_unreported(progress_state, frame_idx):
+        print(f"Processed frame {frame_progress(frame_idx, selection['count'])}")
 
     cap.release()
-    if out:
+    for out in outs:
         out.release()
 
+    if dirty_ratios:
+        print(f"Average dirty cells per frame: {np.mean(dirty_ratios):.1%}")
+    if trace:
+        trace.close()
+    if frame_times:
+        print(summarize(frame_times, time.perf_counter() - loop_start))
+    profile = profile_report(profile_state, options.profile_output)
+    if profile:
+        print(profile)
     print("Video conversion completed successfully!")
 
 
 
 if __name__ == '__main__':
     options = parse_arguments()
-    execute_conversion(options)
+    if options.shards and PIPE in (options.input, options.output):
+        raise ValueError("Segments are converted by processes of their own, which cannot share a pipe")
+    if options.shards and options.shard is None:
+        # Convert the segments here unless they were converted elsewhere, then join them
+        outputs = [sized_output(options.output, num_cols, options.num_cols) for num_cols in options.num_cols]
+        for output in outputs:
+            check_join(output)
+        if not options.join:
+            convert_shards(__file__, sys.argv[1:], options.shards)
+        for output in outputs:
+            join_shards(output, options.shards)
+            print(f"Joined {options.shards} segments into results/{output}")
+    elif options.output == PIPE:
+        # Frames go to standard output, so messages go to standard error
+        with contextlib.redirect_stdout(sys.stderr):
+            execute_conversion(options)
+    else:
+        execute_conversion(options)